@@ -4,169 +4,391 @@ warnings.filterwarnings("ignore", category=CryptographyDeprecationWarning)
 
 from flask import Flask, request
 from telegram.ext import Application
-from telegram.constants import ParseMode
 import pytz  # Import pytz for timezone handling
 
-from PIL import Image
-from io import BytesIO
-import re
 import source.config as config
 import logging
 from datetime import datetime
-import requests
 import asyncio
+import atexit
+import signal
+import sys
+import time
+import os
+import socket
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from pymongo import MongoClient
+from source.dispatcher import Dispatcher
+from source.subscribers import SubscriberIndex
+from source.file_ids import FileIdCache
+from source.metadata import MetadataCache
+from source.delivery import DeliveryEngine
+from source.history import HistoryWriter
+from source.dedup import DeliveryDeduplicator
+from source.render import RenderedTransaction, your_wallet
+from source.activity import ActivityTracker, DELIVER, SUMMARY
+from source.images import ImageProcessor
+from source.schema import SchemaManager
+from source.outbox import Outbox, OutboxWorker
+from source.resolver import MetadataResolver
+from source.digest import DigestCoalescer
+from source import metrics
+from source import http_client
 
 # Configuration
 MONGODB_URI = config.MONGODB_URI
 BOT_TOKEN = config.BOT_TOKEN
 HELIUS_KEY = config.HELIUS_KEY
+HELIUS_API_URL = config.HELIUS_API_URL
+HELIUS_RPC_URL = config.HELIUS_RPC_URL
+
+# Image workers are started up front so the first images don't wait for them to load
+images = ImageProcessor(
+    workers=config.IMAGE_WORKERS,
+    max_bytes=config.IMAGE_MAX_BYTES,
+    max_pixels=config.IMAGE_MAX_PIXELS,
+    download_timeout=config.IMAGE_DOWNLOAD_TIMEOUT,
+    process_timeout=config.IMAGE_PROCESS_TIMEOUT,
+)
+images.start()
 
 # Database setup
 client = MongoClient(MONGODB_URI)
 db = client.sol_wallets
-wallets_collection = db.wallets
+wallets_collection = db[config.WALLETS_COLLECTION]
+SchemaManager(
+    db,
+    {'wallets': wallets_collection.name},
+    migration_timeout=config.SCHEMA_MIGRATION_TIMEOUT,
+    migration_wait=config.SCHEMA_MIGRATION_WAIT,
+).bootstrap(check=config.SCHEMA_CHECK, strict=config.SCHEMA_CHECK_STRICT)
 
 # Set up logging
 logging.basicConfig(
-    filename='wallet.log',
+    filename=os.path.join(config.LOG_DIR, 'wallet.log'),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Initialize Telegram application with explicit timezone
-application = Application.builder().token(BOT_TOKEN).arbitrary_callback_data(True).build()
+# Resident address -> subscribers index, replaces the per-event wallets query
+subscribers = SubscriberIndex(
+    wallets_collection,
+    poll_interval=config.SUBSCRIBER_POLL_INTERVAL,
+    check_interval=config.SUBSCRIBER_CHECK_INTERVAL,
+    change_streams=config.SUBSCRIBER_CHANGE_STREAMS,
+)
+subscribers.start()
+
+# Per-minute transaction counts of tracked wallets, to hold back hyperactive ones
+activity = ActivityTracker(
+    db.noisy_wallets,
+    window_minutes=config.ACTIVITY_WINDOW_MINUTES,
+    limit=config.ACTIVITY_LIMIT,
+    action=config.ACTIVITY_ACTION,
+    sample_every=config.ACTIVITY_SAMPLE_EVERY,
+    summary_interval=config.ACTIVITY_SUMMARY_INTERVAL,
+    report_interval=config.ACTIVITY_REPORT_INTERVAL,
+    max_addresses=config.ACTIVITY_MAX_ADDRESSES,
+)
+
+# Telegram file_ids of already uploaded images, keyed by image URL
+file_ids = FileIdCache(db.file_ids, max_size=config.FILE_ID_CACHE_SIZE, ttl=config.FILE_ID_CACHE_TTL)
+
+# NFT image URLs keyed by mint / compressed asset ID
+metadata_cache = MetadataCache(
+    db.nft_metadata,
+    max_size=config.METADATA_CACHE_SIZE,
+    ttl=config.METADATA_CACHE_TTL,
+    negative_ttl=config.METADATA_NEGATIVE_TTL,
+)
+
+# (signature, user) pairs already handled, Helius retries slow deliveries
+dedup = DeliveryDeduplicator(db.delivered, max_size=config.DEDUP_CACHE_SIZE, ttl=config.DEDUP_TTL)
+
+# Message history is written behind the delivery path in batches
+history = HistoryWriter(
+    db.messages,
+    batch_size=config.HISTORY_BATCH_SIZE,
+    flush_interval=config.HISTORY_FLUSH_INTERVAL,
+    max_buffer=config.HISTORY_MAX_BUFFER,
+    spill_path=config.HISTORY_SPILL_PATH,
+)
+history.start()
+
+# Rendered deliveries are persisted before any send, so a crash mid fan-out is resumed
+outbox = Outbox(
+    db.outbox,
+    lease_seconds=config.OUTBOX_LEASE_SECONDS,
+    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+    retry_delay=config.OUTBOX_RETRY_DELAY,
+)
+
+# One shared Bot client, its connection pool sized for concurrent delivery
+application = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .base_url(config.TELEGRAM_API_URL)
+    .arbitrary_callback_data(True)
+    .connection_pool_size(config.DELIVERY_CONCURRENCY)
+    .build()
+)
 
 # Explicitly configure the job queue's timezone
 application.job_queue.scheduler.configure(timezone=pytz.UTC)
 
-async def send_message_to_user(user_id, message):
-    await application.bot.send_message(
-        chat_id=user_id,
-        text=message,
-        parse_mode=ParseMode.MARKDOWN,
-        disable_web_page_preview=True
-    )
-
-async def send_image_to_user(user_id, message, image_url):
-    image_bytes = get_image(image_url)
-    await application.bot.send_photo(
-        chat_id=user_id,
-        photo=image_bytes,
-        caption=message,
-        parse_mode=ParseMode.MARKDOWN
-    )
+def get_json_image(url_meta):
+    r = http_client.request('GET', url_meta, 'metadata_uri')
+    return r.json().get('image', '')
 
-def get_image(url):
-    response = requests.get(url).content
-    image = Image.open(BytesIO(response))
-    image = image.convert('RGB')
-    max_size = (800, 800)
-    
-    try:
-        resample = Image.Resampling.LANCZOS
-    except AttributeError:
-        resample = Image.ANTIALIAS
-        
-    image.thumbnail(max_size, resample)
-    image_bytes = BytesIO()
-    image.save(image_bytes, 'JPEG', quality=85)
-    image_bytes.seek(0)
-    return image_bytes
-
-def format_wallet_address(match_obj):
-    wallet_address = match_obj.group(0)
-    return wallet_address[:4] + "..." + wallet_address[-4:]
-
-def get_compressed_image(asset_id):
-    url = f'https://rpc.helius.xyz/?api-key={HELIUS_KEY}'
+def get_compressed_images(asset_ids):
+    """
+    Resolves the images of compressed NFTs with one getAssetBatch call.
+    Assets whose off-chain JSON couldn't be fetched map to the exception, so
+    a temporary error isn't cached as "no image".
+    """
+    url = f'{HELIUS_RPC_URL}/?api-key={HELIUS_KEY}'
     r_data = {
         "jsonrpc": "2.0",
         "id": "my-id",
-        "method": "getAsset",
-        "params": [asset_id]
+        "method": "getAssetBatch",
+        "params": {"ids": asset_ids}
     }
-    r = requests.post(url, json=r_data)
-    url_meta = r.json()['result']['content']['json_uri']
-    r = requests.get(url=url_meta)
-    return r.json()['image']
+    r = http_client.request('POST', url, 'helius_rpc.getAssetBatch', json=r_data)
+    images = {}
+    json_uris = {}
+    for asset_id, asset in zip(asset_ids, r.json()['result']):
+        content = (asset or {}).get('content') or {}
+        image = (content.get('links') or {}).get('image')
+        if image:
+            images[asset_id] = image
+        elif content.get('json_uri'):
+            json_uris[asset_id] = content['json_uri']
+        else:
+            images[asset_id] = ''
 
-def check_image(data):
+    # The off-chain JSON is on a different host per collection, fetched side by side
+    fetches = {asset_id: json_pool.submit(get_json_image, uri) for asset_id, uri in json_uris.items()}
+    for asset_id, fetch in fetches.items():
+        try:
+            images[asset_id] = fetch.result()
+        except Exception as e:
+            logger.error(f"Error fetching metadata of asset {asset_id}: {str(e)}")
+            images[asset_id] = e
+    return images
+
+def get_token_images(token_mints):
+    """Resolves the images of a batch of mints with one token-metadata call."""
+    url = f"{HELIUS_API_URL}/v0/token-metadata?api-key={HELIUS_KEY}"
+    r_data = {
+        "mintAccounts": token_mints,
+        "includeOffChain": True,
+        "disableCache": False,
+    }
+
+    r = http_client.request('POST', url, 'helius.token_metadata', json=r_data)
+    images = {}
+    for item in r.json():
+        metadata = (item.get('offChainMetadata') or {}).get('metadata') or {}
+        images[item.get('account')] = metadata.get('image', '')
+    return images
+
+json_pool = ThreadPoolExecutor(max_workers=config.RESOLVER_JSON_WORKERS, thread_name_prefix='metadata-json')
+metadata_resolver = MetadataResolver(
+    metadata_cache,
+    get_token_images,
+    get_compressed_images,
+    window=config.RESOLVER_WINDOW,
+    mint_batch=config.RESOLVER_MINT_BATCH,
+    asset_batch=config.RESOLVER_ASSET_BATCH,
+)
+
+def image_key(transaction):
+    """Returns the metadata cache key of the NFT a transaction involves, or None."""
     token_mint = ''
-    for token in data[0]['tokenTransfers']:
+    for token in transaction['tokenTransfers']:
         if 'NonFungible' in token['tokenStandard']:
             token_mint = token['mint']
 
     if len(token_mint) > 0:
-        url = f"https://api.helius.xyz/v0/token-metadata?api-key={HELIUS_KEY}"
-        nft_addresses = [token_mint]
-        r_data = {
-            "mintAccounts": nft_addresses,
-            "includeOffChain": True,
-            "disableCache": False,
-        }
+        return f'mint:{token_mint}'
+    if 'compressed' in transaction['events']:
+        if 'assetId' in transaction['events']['compressed'][0]:
+            return f"asset:{transaction['events']['compressed'][0]['assetId']}"
+    return None
 
-        r = requests.post(url=url, json=r_data)
-        j = r.json()
-        return j[0]['offChainMetadata']['metadata'].get('image', '')
-    else:
-        if 'compressed' in data[0]['events']:
-            if 'assetId' in data[0]['events']['compressed'][0]:
-                asset_id = data[0]['events']['compressed'][0]['assetId']
-                try:
-                    return get_compressed_image(asset_id)
-                except Exception:
-                    return ''
-        return ''
+def check_image(transaction):
+    """
+    Starts resolving a transaction's NFT image. Lookups from all in-flight
+    events are batched, so callers should start every lookup they need
+    before waiting on any.
+    Returns:
+        Future: Resolves to the image URL, or '' if there is none.
+    """
+    key = image_key(transaction)
+    if key is None:
+        future = Future()
+        future.set_result('')
+        return future
+    return metadata_resolver.resolve(key)
 
-def create_message(data):
-    tx_type = data[0]['type'].replace("_", " ")
-    tx = data[0]['signature']
-    source = data[0]['source']
-    description = data[0]['description']
-
-    accounts = []
-    for inst in data[0]["instructions"]:
-        accounts += inst["accounts"]
-        
-    if len(data[0]['tokenTransfers']) > 0:
-        for token in data[0]['tokenTransfers']:
-            accounts.extend([token['fromUserAccount'], token['toUserAccount']])
-        accounts = list(set(accounts))
-
-    image = check_image(data)
-    
-    found_docs = list(wallets_collection.find(
-        {"address": {"$in": accounts}, "status": "active"}
-    ))
-    found_users = {i['user_id'] for i in found_docs}
-    
+def get_accounts(transaction):
+    accounts = set()
+    for inst in transaction["instructions"]:
+        accounts.update(inst["accounts"])
+
+    for token in transaction['tokenTransfers']:
+        accounts.update([token['fromUserAccount'], token['toUserAccount']])
+    accounts.discard('')
+    return accounts
+
+# Claimed once per signature besides the (signature, user) pairs, so a
+# transaction counts toward its wallets' activity once however often Helius
+# redelivers it. No Telegram user has an empty ID.
+ACTIVITY_CLAIM = ''
+
+def throttle_noisy(tracked, user_wallets, summaries):
+    """
+    Counts a transaction against each tracked wallet it touches and drops
+    the users whose wallets are all being held back for being too active.
+    Noisy wallets due a summary are added to `summaries`.
+    """
+    decisions = {wallet: activity.record(wallet) for wallet in tracked}
+    if all(decision == DELIVER for decision in decisions.values()):
+        return user_wallets
+    summaries.update(wallet for wallet, decision in decisions.items() if decision == SUMMARY)
+    return {
+        user: wallets for user, wallets in user_wallets.items()
+        if any(decisions[wallet] == DELIVER for wallet in wallets)
+    }
+
+def activity_summaries(wallets):
+    """Builds the summary messages sent in place of a noisy wallet's notifications."""
     messages = []
-    for user in found_users:
-        message = f'*{tx_type}*' + (f' on {source}' if source != "SYSTEM_PROGRAM" else '')
-        if description:
-            message += f'\n\n{description}'
-
-            user_wallets = [i['address'] for i in found_docs if i['user_id'] == user]
-            for wallet in user_wallets:
-                if wallet in message:
-                    formatted = f'*YOUR WALLET* ({wallet[:4]}...{wallet[-4:]})'
-                    message = message.replace(wallet, formatted)
-
-        formatted_text = re.sub(r'[A-Za-z0-9]{32,44}', format_wallet_address, message)
-        formatted_text += f'\n[XRAY](https://xray.helius.xyz/tx/{tx}) | [Solscan](https://solscan.io/tx/{tx})'
-        formatted_text = formatted_text.replace("#", "").replace("_", " ")
-        messages.append({'user': user, 'text': formatted_text, 'image': image})
+    now = int(time.time())
+    for wallet in wallets:
+        total, skipped = activity.summary(wallet)
+        text = (
+            f"*BUSY WALLET* {your_wallet(wallet)}\n\n"
+            f"{total} transactions in the last {config.ACTIVITY_WINDOW_MINUTES} minutes, "
+            f"{skipped} notifications skipped. You'll get a summary like this instead "
+            f"until the wallet calms down."
+        )
+        for user in subscribers.lookup([wallet]):
+            messages.append({
+                'user': user,
+                'text': text,
+                'image': '',
+                'signature': f'activity-{wallet}-{now}',
+                'heading': '*BUSY WALLET*',
+            })
     return messages
 
-app = Flask(__name__)
+def build_messages(candidates, fresh):
+    """Resolves images and renders the messages of the claimed (signature, user) pairs."""
+    # Start every image lookup first, so they share batched Helius calls
+    pending = []
+    for transaction, user_wallets in candidates:
+        signature = transaction['signature']
+        duplicates = len(user_wallets)
+        user_wallets = {user: wallets for user, wallets in user_wallets.items() if (signature, user) in fresh}
+        duplicates -= len(user_wallets)
+        if duplicates:
+            metrics.DUPLICATES.inc(duplicates)
+        if not user_wallets:
+            logger.info(f"Duplicate delivery of {signature}, skipping")
+            continue
 
-@app.route('/wallet', methods=['POST'])
-def handle_webhook():
-    data = request.json
-    messages = create_message(data)
+        try:
+            image = check_image(transaction)
+        except Exception as e:
+            logger.error(f"Error checking image for {signature}: {str(e)}")
+            image = None
+        pending.append((transaction, user_wallets, image))
+
+    messages = []
+    for transaction, user_wallets, image in pending:
+        signature = transaction['signature']
+        try:
+            with metrics.timed('metadata', signature):
+                image = image.result(timeout=config.RESOLVER_TIMEOUT) if image is not None else ''
+        except Exception as e:
+            logger.error(f"Error checking image for {signature}: {str(e)}")
+            image = ''
+
+        # Render once per transaction, then only swap in each user's own wallets
+        with metrics.timed('render', signature, users=len(user_wallets)):
+            rendered = RenderedTransaction(transaction)
+            for user, wallets in user_wallets.items():
+                text = rendered.for_user(wallets)
+                messages.append({
+                    'user': user,
+                    'text': text,
+                    'image': image,
+                    'signature': signature,
+                    'heading': rendered.heading,
+                })
+    return messages
+
+def create_message(data):
+    """Builds the per-user messages for every transaction in a webhook payload."""
+    lookups = []
+    for transaction in data:
+        try:
+            accounts = get_accounts(transaction)
+        except (KeyError, TypeError) as e:
+            logger.error(f"Skipping malformed transaction {transaction.get('signature')}: {str(e)}")
+            continue
+
+        with metrics.timed('subscriber_lookup', transaction['signature']):
+            tracked = subscribers.tracked(accounts)
+            # Filters apply here, so muted events cost no metadata, image or render work
+            user_wallets = subscribers.lookup(accounts, transaction) if tracked else {}
+        if tracked:
+            lookups.append((transaction, tracked, user_wallets))
+
+    # Drop redelivered (signature, user) pairs before any metadata or image work
+    with metrics.timed('dedup_claim'):
+        fresh = dedup.claim([
+            (transaction['signature'], user)
+            for transaction, _, user_wallets in lookups
+            for user in [ACTIVITY_CLAIM, *user_wallets]
+        ])
+
+    # Activity counts every new transaction of a tracked wallet, filtered out or not
+    candidates = []
+    summaries = set()
+    for transaction, tracked, user_wallets in lookups:
+        if (transaction['signature'], ACTIVITY_CLAIM) in fresh:
+            user_wallets = throttle_noisy(tracked, user_wallets, summaries)
+        if user_wallets:
+            candidates.append((transaction, user_wallets))
+
+    try:
+        messages = build_messages(candidates, fresh)
+    except Exception:
+        # Unclaimed, so a redelivery of this payload isn't dropped as a duplicate
+        dedup.release(fresh)
+        raise
+    if summaries:
+        messages.extend(activity_summaries(summaries))
+    metrics.MESSAGES.inc(len(messages))
+    return messages
+
+def is_valid_payload(data):
+    if not isinstance(data, list) or len(data) == 0:
+        return False
+    return all(isinstance(tx, dict) and 'signature' in tx for tx in data)
+
+async def process_event(item):
+    data, enqueued_at = item
+    waited = time.perf_counter() - enqueued_at
+    metrics.STAGE_SECONDS.observe(waited, stage='queue_wait')
+    for transaction in data:
+        metrics.traces.record(transaction['signature'], 'queue_wait', waited)
+
+    messages = await asyncio.get_running_loop().run_in_executor(ingest_pool, create_message, data)
 
     for message in messages:
         db_entry = {
@@ -174,20 +396,132 @@ def handle_webhook():
             "message": message['text'],
             "datetime": datetime.now()
         }
-        db.messages.insert_one(db_entry)
+        history.add(db_entry)
         logger.info(message)
 
+    # The webhook is already acknowledged, so a failed enqueue is retried here
+    for attempt in range(config.OUTBOX_ENQUEUE_RETRIES + 1):
         try:
-            if message['image']:
-                asyncio.run(send_image_to_user(message['user'], message['text'], message['image']))
-            else:
-                asyncio.run(send_message_to_user(message['user'], message['text']))
+            await asyncio.to_thread(outbox.enqueue, messages)
+            break
         except Exception as e:
-            logger.error(f"Error sending message: {str(e)}")
-            asyncio.run(send_message_to_user(message['user'], message['text']))
-
+            if attempt == config.OUTBOX_ENQUEUE_RETRIES:
+                # Not queued, so the claims must not turn a later redelivery into a duplicate
+                await asyncio.to_thread(dedup.release, [(message['signature'], message['user']) for message in messages])
+                raise
+            logger.warning(f"Outbox enqueue failed, retrying: {str(e)}")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    if outbox_worker is not None:
+        outbox_worker.wake()
     logger.info('ok event')
+
+delivery = None
+outbox_worker = None
+outbox_depth_task = None
+
+async def start_bot():
+    global delivery, outbox_worker, outbox_depth_task
+    await application.bot.initialize()
+    # Created on the worker loop, which its asyncio primitives belong to
+    delivery = DeliveryEngine(
+        application.bot,
+        file_ids,
+        images.get,
+        rate=config.DELIVERY_RATE,
+        chat_interval=config.DELIVERY_CHAT_INTERVAL,
+        concurrency=config.DELIVERY_CONCURRENCY,
+        max_retries=config.DELIVERY_MAX_RETRIES,
+    )
+    digests = DigestCoalescer(
+        delivery.deliver,
+        db.users,
+        window=config.DIGEST_WINDOW,
+        threshold=config.DIGEST_THRESHOLD,
+        default_enabled=config.DIGEST_DEFAULT,
+        max_lines=config.DIGEST_MAX_LINES,
+        preference_ttl=config.DIGEST_PREFERENCE_TTL,
+    )
+    if config.OUTBOX_INLINE_WORKER:
+        outbox_worker = OutboxWorker(
+            outbox,
+            digests.deliver_many,
+            owner=f'{socket.gethostname()}:{os.getpid()}:app',
+            batch_size=config.OUTBOX_BATCH_SIZE,
+            loops=config.OUTBOX_LOOPS,
+            poll_interval=config.OUTBOX_POLL_INTERVAL,
+        )
+        outbox_worker.start()
+    outbox_depth_task = asyncio.create_task(track_outbox_depth())
+
+async def track_outbox_depth():
+    """Refreshes the outbox depth gauge, so scrapes never wait on Mongo."""
+    while True:
+        try:
+            depth = await asyncio.to_thread(outbox.pending_count)
+            metrics.QUEUE_DEPTH.set(depth, queue='outbox')
+        except Exception as e:
+            logger.error(f"Error counting the outbox: {str(e)}")
+        await asyncio.sleep(config.OUTBOX_DEPTH_INTERVAL)
+
+async def stop_bot():
+    if outbox_depth_task is not None:
+        outbox_depth_task.cancel()
+    if outbox_worker is not None:
+        await outbox_worker.stop()
+    await application.bot.shutdown()
+
+# One thread per dispatch worker, apart from the loop's executor that the
+# outbox and delivery use, so metadata waits in create_message never starve them
+ingest_pool = ThreadPoolExecutor(max_workers=config.DISPATCH_WORKERS, thread_name_prefix='ingest')
+dispatcher = Dispatcher(
+    process_event,
+    workers=config.DISPATCH_WORKERS,
+    max_queue=config.DISPATCH_QUEUE_SIZE,
+    enqueue_timeout=config.DISPATCH_ENQUEUE_TIMEOUT,
+    on_start=start_bot,
+    on_stop=stop_bot,
+    threads=config.DISPATCH_THREADS,
+)
+dispatcher.start()
+metrics.QUEUE_DEPTH.set_function(dispatcher.qsize, queue='dispatch')
+metrics.QUEUE_DEPTH.set_function(history.qsize, queue='history')
+# Traces and metrics are for operators only, never on the public webhook bind
+metrics.serve(config.METRICS_HOST, config.METRICS_PORT)
+# atexit runs in reverse order: drain the dispatcher before the last history flush
+atexit.register(images.stop)
+atexit.register(history.stop)
+atexit.register(dispatcher.stop)
+
+app = Flask(__name__)
+
+@app.route('/wallet', methods=['POST'])
+def handle_webhook():
+    started = time.perf_counter()
+    data = request.get_json(silent=True)
+    if not is_valid_payload(data):
+        logger.warning('invalid payload')
+        metrics.WEBHOOKS.inc(status='400')
+        return 'Bad Request', 400
+
+    parsed = time.perf_counter()
+    metrics.STAGE_SECONDS.observe(parsed - started, stage='parse')
+    metrics.EVENTS.inc(len(data))
+    for transaction in data:
+        metrics.traces.record(transaction['signature'], 'parse', parsed - started, transactions=len(data))
+
+    # Helius retries on non-2xx, so a full queue pushes back instead of dropping
+    if not dispatcher.submit((data, parsed)):
+        metrics.WEBHOOKS.inc(status='503')
+        return 'Busy', 503
+
+    metrics.WEBHOOKS.inc(status='200')
     return 'OK'
 
+def handle_sigterm(signum, frame):
+    # Exit through atexit, which drains the dispatch queue and flushes history
+    logger.info('SIGTERM received, shutting down')
+    sys.exit(0)
+
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, handle_sigterm)
     app.run(host='0.0.0.0', port=5002)
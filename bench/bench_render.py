@@ -0,0 +1,133 @@
+"""
+Micro-benchmark for per-user message rendering.
+
+Compares the original per-user pipeline (replace + regex + replace for every
+recipient) with RenderedTransaction, checks that both produce the same bytes
+on random and hand-picked transactions, and times a fan-out.
+
+    python -m bench.bench_render [--users 200] [--rounds 50]
+"""
+import argparse
+import random
+import re
+import string
+import timeit
+
+from source.render import RenderedTransaction
+
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def format_wallet_address(match_obj):
+    wallet_address = match_obj.group(0)
+    return wallet_address[:4] + "..." + wallet_address[-4:]
+
+
+def legacy_render(transaction, user_wallets):
+    """The per-user rendering as it was done inside create_message."""
+    tx_type = transaction['type'].replace("_", " ")
+    tx = transaction['signature']
+    source = transaction['source']
+    description = transaction['description']
+
+    message = f'*{tx_type}*' + (f' on {source}' if source != "SYSTEM_PROGRAM" else '')
+    if description:
+        message += f'\n\n{description}'
+
+        for wallet in user_wallets:
+            if wallet in message:
+                formatted = f'*YOUR WALLET* ({wallet[:4]}...{wallet[-4:]})'
+                message = message.replace(wallet, formatted)
+
+    formatted_text = re.sub(r'[A-Za-z0-9]{32,44}', format_wallet_address, message)
+    formatted_text += f'\n[XRAY](https://xray.helius.xyz/tx/{tx}) | [Solscan](https://solscan.io/tx/{tx})'
+    formatted_text = formatted_text.replace("#", "").replace("_", " ")
+    return formatted_text
+
+
+def address(rng, length=44):
+    return ''.join(rng.choice(BASE58) for _ in range(length))
+
+
+def random_transaction(rng, wallets):
+    words = ['transferred', 'a total', 'SOL to', 'sold', 'for', '#1234', 'NFT_SALE', 'to', 'on', '_', '-', '.']
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        roll = rng.random()
+        if roll < 0.3:
+            parts.append(rng.choice(wallets))
+        elif roll < 0.4:
+            # Wallets glued to other text, or to each other
+            parts.append(rng.choice(wallets) + rng.choice(['', 'x', rng.choice(wallets), '#', '_']))
+        elif roll < 0.5:
+            parts.append(''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(30, 100))))
+        else:
+            parts.append(rng.choice(words))
+    return {
+        'type': rng.choice(['TRANSFER', 'NFT_SALE', 'UNKNOWN']),
+        'source': rng.choice(['SYSTEM_PROGRAM', 'MAGIC_EDEN', 'TENSOR']),
+        'signature': address(rng, 88),
+        'description': rng.choice([' ', '', '\n']).join(parts),
+    }
+
+
+def check_equivalence(rng, cases=20000):
+    wallets = [address(rng, rng.choice([32, 43, 44])) for _ in range(12)]
+    # A wallet that is a substring of another one
+    wallets.append(wallets[0][:36])
+    for _ in range(cases):
+        transaction = random_transaction(rng, wallets)
+        rendered = RenderedTransaction(transaction)
+        user_wallets = rng.sample(wallets, rng.randint(0, 4))
+        expected = legacy_render(transaction, user_wallets)
+        actual = rendered.for_user(user_wallets)
+        assert expected == actual, (transaction, user_wallets, expected, actual)
+    print(f"equivalence: {cases} random cases match")
+
+
+def fanout_transaction(rng, users):
+    wallets = [address(rng) for _ in range(users)]
+    counterparties = [address(rng) for _ in range(4)]
+    description = (
+        f"{wallets[0]} sold Mad Lads #4242 to {counterparties[0]} for 120 SOL on MAGIC_EDEN. "
+        f"{counterparties[1]} transferred 0.01 SOL to {wallets[1 % users]} and {counterparties[2]}."
+    )
+    transaction = {
+        'type': 'NFT_SALE',
+        'source': 'MAGIC_EDEN',
+        'signature': address(rng, 88),
+        'description': description,
+    }
+    recipients = [[wallets[i]] for i in range(users)]
+    return transaction, recipients
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help='recipients per transaction')
+    parser.add_argument('--rounds', type=int, default=50, help='timed fan-outs')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    check_equivalence(rng)
+
+    transaction, recipients = fanout_transaction(rng, args.users)
+
+    def legacy():
+        return [legacy_render(transaction, wallets) for wallets in recipients]
+
+    def rendered():
+        prepared = RenderedTransaction(transaction)
+        return [prepared.for_user(wallets) for wallets in recipients]
+
+    assert legacy() == rendered()
+    legacy_time = min(timeit.repeat(legacy, number=args.rounds, repeat=5)) / args.rounds
+    rendered_time = min(timeit.repeat(rendered, number=args.rounds, repeat=5)) / args.rounds
+    print(f"fan-out to {args.users} users:")
+    print(f"  legacy   {legacy_time * 1e3:8.3f} ms/tx")
+    print(f"  rendered {rendered_time * 1e3:8.3f} ms/tx  ({legacy_time / rendered_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Local stand-ins for Helius, the Telegram Bot API and NFT image hosts.
+
+Every server runs in a background thread on 127.0.0.1 and takes a latency
+(seconds, +-50% jitter) and an error rate, so the pipeline can be measured
+under slow or flaky dependencies without touching the real services.
+"""
+import json
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+SIGNATURE_PATTERN = re.compile(r'solscan\.io/tx/([A-Za-z0-9]+)')
+
+
+class FakeServer:
+    """
+    Base class: a threaded HTTP server that routes to `handle(method, path, query, body, headers)`.
+    Args:
+        latency (float): Mean added latency per request in seconds.
+        error_rate (float): Probability of answering with an error.
+        seed (int): Seed for the latency / error randomness.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+                server._delay()
+                try:
+                    status, content_type, payload = server.handle(
+                        method, url.path, parse_qs(url.query), body, self.headers
+                    )
+                except Exception as e:
+                    status, content_type, payload = 500, 'text/plain', str(e).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def do_PUT(self):
+                self._dispatch('PUT')
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self) -> 'FakeServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+    def _delay(self) -> None:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency * self._random.uniform(0.5, 1.5) if self.latency else 0
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    @staticmethod
+    def json(payload, status: int = 200):
+        return status, 'application/json', json.dumps(payload).encode()
+
+    def handle(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+
+class FakeImageHost(FakeServer):
+    """Serves one generated PNG of `size` pixels for any path."""
+
+    def __init__(self, size=(1600, 1600), **kwargs):
+        super().__init__(**kwargs)
+        from PIL import Image
+
+        image = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 100).convert('RGB')
+        buffer = BytesIO()
+        image.save(buffer, 'PNG')
+        self.image = buffer.getvalue()
+
+    def handle(self, method, path, query, body, headers):
+        if self.should_fail():
+            return 500, 'text/plain', b'error'
+        return 200, 'image/png', self.image
+
+
+class FakeHelius(FakeServer):
+    """
+    Helius REST (token-metadata, webhooks, raw-transactions) and RPC (getAsset,
+    getAssetBatch) endpoints. Images resolve to `image_url`; roughly every
+    tenth mint has no image to exercise negative caching.
+    """
+
+    def __init__(self, image_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.image_url = image_url
+        self.webhooks = {}
+        self.webhook_urls = {}
+
+    def _image(self, key: str) -> str:
+        return '' if key.endswith('9') else f'{self.image_url}/{key}.png'
+
+    def _asset(self, asset_id: str) -> dict:
+        return {'id': asset_id, 'content': {'json_uri': f'{self.url}/json/{asset_id}'}}
+
+    def handle(self, method, path, query, body, headers):
+        if self.should_fail():
+            return self.json({'error': 'internal error'}, 500)
+
+        request = json.loads(body) if body else {}
+        if path == '/v0/token-metadata':
+            return self.json([
+                {'account': mint, 'offChainMetadata': {'metadata': {'image': self._image(mint)}}}
+                for mint in request.get('mintAccounts', [])
+            ])
+        if path.startswith('/json/'):
+            return self.json({'image': self._image(path.rsplit('/', 1)[-1])})
+        if path == '/v0/webhooks':
+            return self.json([
+                {'webhookID': webhook_id, 'webhookURL': self.webhook_urls.get(webhook_id), 'accountAddresses': addresses}
+                for webhook_id, addresses in self.webhooks.items()
+            ])
+        if path.startswith('/v0/webhooks/'):
+            webhook_id = path.rsplit('/', 1)[-1]
+            if method == 'PUT':
+                self.webhooks[webhook_id] = request.get('accountAddresses', [])
+                self.webhook_urls[webhook_id] = request.get('webhookURL')
+            return self.json({'webhookID': webhook_id, 'accountAddresses': self.webhooks.get(webhook_id, [])})
+        if path.endswith('/raw-transactions'):
+            return self.json([])
+        if path == '/':
+            if request.get('method') == 'getAsset':
+                result = self._asset(request['params'][0] if isinstance(request['params'], list) else request['params']['id'])
+            elif request.get('method') == 'getAssetBatch':
+                result = [self._asset(i) for i in request['params']['ids']]
+            else:
+                return self.json({'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': -32601}}, 400)
+            return self.json({'jsonrpc': '2.0', 'id': request.get('id'), 'result': result})
+        return self.json({'error': 'not found'}, 404)
+
+
+class FakeTelegram(FakeServer):
+    """
+    Bot API stand-in for getMe, sendMessage and sendPhoto. Failures are split
+    between 429 flood control answers and 502s. Every delivered message is
+    recorded as (monotonic time, chat_id, signature, kind).
+    """
+
+    def __init__(self, retry_after: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+        self.deliveries = []
+        self._message_id = 0
+
+    @staticmethod
+    def _params(body: bytes, headers) -> dict:
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('multipart/'):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+            )
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    params[name] = part.get_payload(decode=True)
+                else:
+                    params[name] = part.get_content()
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def handle(self, method, path, query, body, headers):
+        api_method = path.rsplit('/', 1)[-1]
+        if api_method == 'getMe':
+            return self.json({'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+            }})
+
+        if self.should_fail():
+            if self._random.random() < 0.5:
+                return self.json({
+                    'ok': False, 'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }, 429)
+            return self.json({'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, 502)
+
+        params = self._params(body, headers)
+        text = params.get('text') or params.get('caption') or ''
+        match = SIGNATURE_PATTERN.search(text)
+        chat_id = params.get('chat_id')
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+            self.deliveries.append((time.monotonic(), chat_id, match.group(1) if match else None, api_method))
+
+        result = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        if api_method == 'sendPhoto':
+            photo = params.get('photo')
+            file_id = photo if isinstance(photo, str) else f'file{message_id}'
+            result['caption'] = text
+            result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 800}]
+        else:
+            result['text'] = text
+        return self.json({'ok': True, 'result': result})
@@ -0,0 +1,262 @@
+"""
+Offline replay benchmark for the webhook pipeline in app.py.
+
+Starts local stand-ins for Helius, Telegram and an image host (bench/fakes.py),
+points app.py at them, seeds subscribers for every account in the corpus and
+replays the recorded payloads against /wallet at a target rate. Reports the
+ingest rate, end-to-end delivery rate and p50/p99 latency from the POST to
+the message reaching the fake Telegram, and the mean time per pipeline stage
+from the metrics histograms.
+
+    python -m bench.replay --rate 50 --duration 20
+    python -m bench.replay --mongo mongodb://localhost:27017/?directConnection=true
+
+The default `--mongo memory` needs mongomock (pip install mongomock); any
+other value is used as a MongoDB connection string. Only point it at a
+throwaway server: the run replaces the contents of the wallets collection
+(WALLETS_COLLECTION, sol_wallets.wallets by default).
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fakes import FakeHelius, FakeImageHost, FakeTelegram
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus')
+
+
+def load_corpus(names):
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(CORPUS, '*.json'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if not names or name in names:
+            with open(path) as f:
+                corpus[name] = json.load(f)
+    if not corpus:
+        sys.exit(f"No corpus files found in {CORPUS}")
+    return corpus
+
+
+def tracked_accounts(transaction):
+    accounts = {transaction.get('feePayer')}
+    for transfer in transaction.get('nativeTransfers', []) + transaction.get('tokenTransfers', []):
+        accounts.update([transfer.get('fromUserAccount'), transfer.get('toUserAccount')])
+    for event in transaction.get('events', {}).get('compressed', []):
+        accounts.add(event.get('newLeafOwner'))
+    accounts.discard(None)
+    accounts.discard('')
+    return accounts
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def start_app(args, fakes):
+    # Logs and the history spill file stay out of the checkout
+    scratch = tempfile.mkdtemp(prefix='soltrack-bench-')
+    os.environ.update({
+        'LOG_DIR': scratch,
+        'MONGODB_URI': args.mongo if args.mongo != 'memory' else 'mongodb://localhost',
+        'BOT_TOKEN': '123456:bench',
+        'HELIUS_KEY': 'bench',
+        'HELIUS_WEBHOOK_URL': 'http://127.0.0.1/wallet',
+        'HELIUS_WEBHOOK_ID': 'bench',
+        'HELIUS_API_URL': fakes['helius'].url,
+        'HELIUS_RPC_URL': fakes['helius'].url,
+        'TELEGRAM_API_URL': f"{fakes['telegram'].url}/bot",
+        'SUBSCRIBER_CHANGE_STREAMS': '1' if args.mongo != 'memory' else '0',
+        # mongomock has no explain()
+        'SCHEMA_CHECK': '1' if args.mongo != 'memory' else '0',
+        'SUBSCRIBER_POLL_INTERVAL': '1',
+        'DELIVERY_RATE': str(args.delivery_rate),
+        'DELIVERY_CHAT_INTERVAL': str(args.chat_interval),
+        'HISTORY_SPILL_PATH': os.path.join(scratch, 'messages_spill.jsonl'),
+        # The corpus' few accounts would otherwise be held back as noisy wallets
+        'ACTIVITY_LIMIT': '1000000000',
+        # Stage timings are read in-process
+        'METRICS_PORT': '0',
+    })
+    if args.mongo == 'memory':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--mongo memory needs mongomock (pip install mongomock), or pass a MongoDB URI")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    import app as webhook_app
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, webhook_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return webhook_app, server, f'http://127.0.0.1:{server.server_port}/wallet'
+
+
+def seed(webhook_app, corpus, subscribers):
+    webhook_app.db.drop_collection('delivered')
+    webhook_app.wallets_collection.delete_many({})
+    docs = []
+    accounts = set()
+    for payload in corpus.values():
+        for transaction in payload:
+            accounts |= tracked_accounts(transaction)
+    for n, address in enumerate(sorted(accounts)):
+        for user in range(subscribers):
+            docs.append({'user_id': str(1000 + n * subscribers + user), 'address': address, 'status': 'active'})
+    webhook_app.wallets_collection.insert_many(docs)
+    webhook_app.subscribers.load()
+    return len(accounts), len(docs)
+
+
+def check_filters(webhook_app, corpus):
+    """Checks that a filter stored on a subscription, as the bot's /filter does, is applied at lookup."""
+    transaction = next(t for payload in corpus.values() for t in payload if tracked_accounts(t))
+    accounts = tracked_accounts(transaction)
+    doc = {'user_id': 'bench-filtered', 'address': sorted(accounts)[0], 'status': 'active',
+           'filters': {'types': ['BENCH_NO_SUCH_TYPE']}}
+    webhook_app.wallets_collection.insert_one(doc)
+    webhook_app.subscribers.load()
+    try:
+        found = webhook_app.subscribers.lookup(accounts, transaction)
+        unfiltered = webhook_app.subscribers.lookup(accounts)
+    finally:
+        webhook_app.wallets_collection.delete_one({'_id': doc['_id']})
+        webhook_app.subscribers.load()
+    if 'bench-filtered' in found or 'bench-filtered' not in unfiltered:
+        sys.exit("filtered subscriber wasn't excluded by SubscriberIndex.lookup")
+
+
+def replay(url, corpus, rate, duration, concurrency):
+    import requests
+
+    names = sorted(corpus)
+    total = int(rate * duration)
+    sent = {}
+    statuses = {}
+    ingest = []
+    lock = threading.Lock()
+    session = requests.Session()
+
+    def post(i):
+        payload = copy.deepcopy(corpus[names[i % len(names)]])
+        for j, transaction in enumerate(payload):
+            # Unique signatures, or the deduplication would drop the replays
+            transaction['signature'] = f"{i:08d}{j}{transaction['signature'][:60]}"
+        started = time.monotonic()
+        try:
+            status = session.post(url, json=payload, timeout=30).status_code
+        except Exception:
+            status = 'error'
+        finished = time.monotonic()
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            ingest.append(finished - started)
+            if status == 200:
+                for transaction in payload:
+                    sent[transaction['signature']] = started
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(post, i)
+    return start, sent, statuses, ingest
+
+
+def wait_for_deliveries(telegram, quiet, timeout):
+    deadline = time.monotonic() + timeout
+    count = -1
+    while time.monotonic() < deadline:
+        if len(telegram.deliveries) == count:
+            break
+        count = len(telegram.deliveries)
+        time.sleep(quiet)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=20, help='webhook POSTs per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of replay')
+    parser.add_argument('--corpus', nargs='*', help='corpus names to replay (default: all)')
+    parser.add_argument('--subscribers', type=int, default=3, help='users tracking every corpus account')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent POSTs')
+    parser.add_argument('--mongo', default='memory', help="'memory' (mongomock) or a MongoDB URI")
+    parser.add_argument('--helius-latency', type=float, default=0.05)
+    parser.add_argument('--helius-errors', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.08)
+    parser.add_argument('--telegram-errors', type=float, default=0.0)
+    parser.add_argument('--image-latency', type=float, default=0.1)
+    parser.add_argument('--image-errors', type=float, default=0.0)
+    parser.add_argument('--image-size', type=int, default=1600, help='edge of the generated NFT image in pixels')
+    parser.add_argument('--delivery-rate', type=float, default=30, help='Telegram messages per second (DELIVERY_RATE)')
+    parser.add_argument('--chat-interval', type=float, default=1, help='seconds between messages to one chat (DELIVERY_CHAT_INTERVAL)')
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    images = FakeImageHost(size=(args.image_size, args.image_size),
+                           latency=args.image_latency, error_rate=args.image_errors, seed=1).start()
+    fakes = {
+        'images': images,
+        'helius': FakeHelius(images.url, latency=args.helius_latency, error_rate=args.helius_errors, seed=2).start(),
+        'telegram': FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_errors, seed=3).start(),
+    }
+
+    corpus = load_corpus(args.corpus)
+    webhook_app, server, url = start_app(args, fakes)
+    accounts, subscriptions = seed(webhook_app, corpus, args.subscribers)
+    check_filters(webhook_app, corpus)
+    print(f"corpus: {', '.join(corpus)} | {accounts} accounts, {subscriptions} subscriptions")
+
+    start, sent, statuses, ingest = replay(url, corpus, args.rate, args.duration, args.concurrency)
+    ingest_done = time.monotonic()
+    wait_for_deliveries(fakes['telegram'], quiet=2, timeout=args.drain_timeout)
+
+    telegram = fakes['telegram']
+    latencies = [at - sent[signature] for at, _, signature, _ in telegram.deliveries if signature in sent]
+    last = max((at for at, _, signature, _ in telegram.deliveries if signature in sent), default=ingest_done)
+    events = sum(statuses.values())
+
+    print(f"webhooks: {events} sent in {ingest_done - start:.1f}s, statuses {statuses}")
+    print(f"ingest:   p50 {percentile(ingest, 50) * 1e3:.1f} ms, p99 {percentile(ingest, 99) * 1e3:.1f} ms")
+    print(f"delivery: {len(latencies)} messages, {events / (last - start):.1f} events/s, "
+          f"{len(latencies) / (last - start):.1f} messages/s")
+    if latencies:
+        print(f"latency:  p50 {percentile(latencies, 50) * 1e3:.0f} ms, p99 {percentile(latencies, 99) * 1e3:.0f} ms, "
+              f"max {max(latencies) * 1e3:.0f} ms, mean {statistics.mean(latencies) * 1e3:.0f} ms")
+    print(f"upstream: helius {fakes['helius'].requests} requests, images {images.requests}, "
+          f"telegram {telegram.requests}")
+
+    stages = {}
+    for line in webhook_app.metrics.STAGE_SECONDS.samples():
+        if line.startswith('soltrack_stage_seconds_sum') or line.startswith('soltrack_stage_seconds_count'):
+            name, value = line.rsplit(' ', 1)
+            stage = name.split('"')[1]
+            stages.setdefault(stage, {})['sum' if '_sum' in name else 'count'] = float(value)
+    print("stages:   " + ', '.join(
+        f"{stage} {values['sum'] / values['count'] * 1e3:.1f} ms" for stage, values in stages.items() if values.get('count')
+    ))
+
+    server.shutdown()
+    webhook_app.dispatcher.stop()
+    webhook_app.images.stop()
+    for fake in fakes.values():
+        fake.stop()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
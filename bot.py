@@ -2,7 +2,9 @@ import warnings
 from cryptography.utils import CryptographyDeprecationWarning
 warnings.filterwarnings("ignore", category=CryptographyDeprecationWarning)
 
+import asyncio
 import logging
+import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -15,9 +17,14 @@ from telegram.ext import (
 )
 
 from pymongo import MongoClient
+from typing import List, Optional, Tuple
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from datetime import datetime
 import source.config as config
 from source.bot_tools import *
+from source.webhook_sync import WebhookSync
+from source.schema import SchemaManager
+from source.filters import describe, parse_filter
 
 # Configuration
 MONGODB_URI = config.MONGODB_URI
@@ -28,14 +35,34 @@ HELIUS_WEBHOOK_ID = config.HELIUS_WEBHOOK_ID
 # Database setup
 client = MongoClient(MONGODB_URI)
 db = client.sol_wallets
-wallets_collection = db.wallets_test
+wallets_collection = db[config.WALLETS_COLLECTION]
+SchemaManager(
+    db,
+    {'wallets': wallets_collection.name},
+    migration_timeout=config.SCHEMA_MIGRATION_TIMEOUT,
+    migration_wait=config.SCHEMA_MIGRATION_WAIT,
+).bootstrap(check=config.SCHEMA_CHECK, strict=config.SCHEMA_CHECK_STRICT)
+
+# Helius webhook address lists, sharded and pushed in the background
+webhook_sync = WebhookSync(
+    wallets_collection,
+    config.HELIUS_WEBHOOK_IDS,
+    managed=db.webhooks,
+    retire=config.HELIUS_RETIRE_REMOVED_WEBHOOKS,
+    window=config.WEBHOOK_SYNC_WINDOW,
+    reconcile_interval=config.WEBHOOK_RECONCILE_INTERVAL,
+    max_addresses=config.HELIUS_WEBHOOK_MAX_ADDRESSES,
+)
 
 # Conversation states
-ADDING_WALLET, DELETING_WALLET = range(2)
+ADDING_WALLET, DELETING_WALLET, IMPORTING_WALLETS = range(3)
+
+MAX_WALLETS = config.MAX_WALLETS_PER_USER
+DUPLICATE_KEY = 11000
 
 # Configure logging
 logging.basicConfig(
-    filename='bot.log',
+    filename=os.path.join(config.LOG_DIR, 'bot.log'),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
@@ -56,7 +83,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             InlineKeyboardButton("✨ Add", callback_data="addWallet"),
             InlineKeyboardButton("🗑️ Delete", callback_data="deleteWallet"),
             InlineKeyboardButton("👀 Show", callback_data="showWallets"),
-        ]
+        ],
+        [InlineKeyboardButton("📥 Import", callback_data="importWallets")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -75,21 +103,27 @@ def create_keyboard():
             InlineKeyboardButton("🗑️ Delete", callback_data="deleteWallet"),
             InlineKeyboardButton("👀 Show", callback_data="showWallets"),
         ],
-        [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        [
+            InlineKeyboardButton("📥 Import", callback_data="importWallets"),
+            InlineKeyboardButton("🔙 Back", callback_data="back"),
+        ]
     ])
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     query = update.callback_query
     await query.answer()
     
+    # The returned state is what starts the conversation
     if query.data == "addWallet":
-        await add_wallet_start(update, context)
+        return await add_wallet_start(update, context)
     elif query.data == "deleteWallet":
-        await delete_wallet_start(update, context)
+        return await delete_wallet_start(update, context)
+    elif query.data == "importWallets":
+        return await import_wallets_start(update, context)
     elif query.data == "showWallets":
         await show_wallets(update, context)
     elif query.data == "back":
-        await back(update, context)
+        return await back(update, context)
 
 async def back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
@@ -119,38 +153,53 @@ async def add_wallet_finish(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Uh-oh! That Solana wallet address seems a bit fishy. Double-check it and send a valid one, please! 🕵️‍♂️")
         return ADDING_WALLET
 
-    check_res, check_num_tx = check_wallet_transactions(wallet_address)
+    # Independent lookups, run concurrently so the slow Helius call sets the pace
+    (check_res, check_num_tx), wallet_count, existing_wallet, filters = await asyncio.gather(
+        check_wallet_transactions_async(wallet_address),
+        wallet_count_for_user_async(user_id, limit=MAX_WALLETS),
+        async_wallets_collection.find_one({
+            "user_id": str(user_id),
+            "address": wallet_address,
+            "status": "active"
+        }, {"_id": 1}),
+        get_filters_async(user_id),
+    )
+
     if not check_res:
         await update.message.reply_text(f"Whoa, slow down Speedy Gonzales! 🏎️ We can only handle wallets with under 50 transactions per day. Your wallet's at {round(check_num_tx, 1)}. Let's pick another, shall we? 😉")
         return ADDING_WALLET
 
-    if wallet_count_for_user(user_id) >= 5:
-        await update.message.reply_text("Oops! You've reached the wallet limit! It seems you're quite the collector, but we can only handle up to 5 wallets per user. Time to make some tough choices! 😄")
+    if wallet_count >= MAX_WALLETS:
+        await update.message.reply_text(f"Oops! You've reached the wallet limit! It seems you're quite the collector, but we can only handle up to {MAX_WALLETS} wallets per user. Time to make some tough choices! 😄")
         return ADDING_WALLET
 
-    existing_wallet = wallets_collection.find_one({
-        "user_id": str(user_id),
-        "address": wallet_address,
-        "status": "active"
-    })
-
     if existing_wallet:
         await update.message.reply_text("Hey there, déjà vu! You've already added this wallet. Time for a different action, perhaps? 🔄", reply_markup=keyboard)
         return ConversationHandler.END
 
-    success, webhook_id, addresses = get_webhook(HELIUS_WEBHOOK_ID)
-    r_success = add_webhook(user_id, wallet_address, webhook_id, addresses)
-
-    if success and r_success:
-        wallets_collection.insert_one({
+    try:
+        wallet = {
             "user_id": str(user_id),
             "address": wallet_address,
             "datetime": datetime.now(),
+            "updated_at": datetime.utcnow(),
             "status": 'active',
-        })
-        await update.message.reply_text("Huzzah! Your wallet has been added with a flourish! 🎉 Now you can sit back, relax, and enjoy your Solana experience as I keep an eye on your transactions. What's your next grand plan?", reply_markup=keyboard)
-    else:
+        }
+        # New wallets follow the user's existing filters
+        if filters:
+            wallet["filters"] = filters
+        await async_wallets_collection.insert_one(wallet)
+    except DuplicateKeyError:
+        # Added concurrently, e.g. from a second chat
+        await update.message.reply_text("Hey there, déjà vu! You've already added this wallet. Time for a different action, perhaps? 🔄", reply_markup=keyboard)
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Error saving wallet: {str(e)}", exc_info=True)
         await update.message.reply_text("Bummer! We hit a snag while saving your wallet. Let's give it another whirl, shall we? 🔄", reply_markup=keyboard)
+        return ConversationHandler.END
+
+    webhook_sync.notify(wallet_address)
+    await update.message.reply_text("Huzzah! Your wallet has been added with a flourish! 🎉 Now you can sit back, relax, and enjoy your Solana experience as I keep an eye on your transactions. What's your next grand plan?", reply_markup=keyboard)
 
     return ConversationHandler.END
 
@@ -167,33 +216,188 @@ async def delete_wallet_finish(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     keyboard = create_keyboard()
 
-    wallets_exist = wallets_collection.find({"address": wallet_address, "status": "active"})
-    r_success = True
+    try:
+        result = await async_wallets_collection.delete_one({"user_id": str(user_id), "address": wallet_address})
+    except Exception as e:
+        logger.error(f"Error deleting wallet: {str(e)}", exc_info=True)
+        await update.message.reply_text("Yikes, we couldn't delete the wallet. Don't worry, we'll get it next time! Try again, please. 🔄", reply_markup=keyboard)
+        return ConversationHandler.END
+
+    if result.deleted_count == 0:
+        await update.message.reply_text("Hmm, that wallet's either missing or not yours. Let's try something else, okay? 🕵️‍♀️", reply_markup=keyboard)
+    else:
+        # The address leaves the webhook once no other user tracks it
+        webhook_sync.notify(wallet_address)
+        await update.message.reply_text("Poof! Your wallet has vanished into thin air! Now, what other adventures await? ✨", reply_markup=keyboard)
 
-    if len(list(wallets_exist.clone())) == 1:
-        logger.info('Deleting unique address')
-        success, webhook_id, addresses = get_webhook(HELIUS_WEBHOOK_ID)
-        r_success = delete_webhook(user_id, wallet_address, webhook_id, addresses)
+    return ConversationHandler.END
 
-    if r_success:
-        result = wallets_collection.delete_one({"user_id": str(user_id), "address": wallet_address})
-        if result.deleted_count == 0:
-            await update.message.reply_text("Hmm, that wallet's either missing or not yours. Let's try something else, okay? 🕵️‍♀️", reply_markup=keyboard)
-        else:
-            await update.message.reply_text("Poof! Your wallet has vanished into thin air! Now, what other adventures await? ✨", reply_markup=keyboard)
+async def import_wallets_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="back")]]
+    text = (
+        "Bringing the whole fleet? 🚢 Paste your wallet addresses (one per line, or separated by commas), "
+        f"or upload them as a .txt or .csv file. Up to {config.IMPORT_MAX_ADDRESSES} at a time!"
+    )
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     else:
-        await update.message.reply_text("Yikes, we couldn't delete the wallet. Don't worry, we'll get it next time! Try again, please. 🔄", reply_markup=keyboard)
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    return IMPORTING_WALLETS
+
+async def import_wallets(user_id: int, addresses: List[str]) -> List[Tuple[str, str]]:
+    """
+    Validates and adds a list of wallets for a user in bulk.
+    Addresses are checked locally first, then against the user's existing
+    wallets and the wallet limit; the transaction rate checks run
+    concurrently. Accepted wallets are saved with one insert_many and pushed
+    to Helius with one webhook update.
+    Args:
+        user_id (int): The ID of the user importing the wallets.
+        addresses (List[str]): The candidate addresses, in the user's order.
+    Returns:
+        List[Tuple[str, str]]: (address, result line) for every address, in order.
+    """
+    results = {}
+    valid = []
+    for address in addresses:
+        if is_solana_wallet_address(address):
+            valid.append(address)
+        else:
+            results[address] = "❌ not a Solana address"
+
+    existing, wallet_count, filters = await asyncio.gather(
+        async_wallets_collection.distinct("address", {
+            "user_id": str(user_id),
+            "address": {"$in": valid},
+            "status": "active"
+        }),
+        wallet_count_for_user_async(user_id),
+        get_filters_async(user_id),
+    )
+    existing = set(existing)
+    candidates = []
+    for address in valid:
+        if address in existing:
+            results[address] = "⏭️ already tracked"
+        else:
+            candidates.append(address)
+
+    # Rate checks run in batches only as large as the free slots need, so a
+    # user at the limit doesn't send hundreds of wasted requests to Helius
+    slots = max(0, MAX_WALLETS - wallet_count)
+    accepted = []
+    position = 0
+    while slots and position < len(candidates):
+        batch = candidates[position:position + max(slots, config.IMPORT_CONCURRENCY)]
+        position += len(batch)
+        checks = await check_wallets_transactions_async(batch, config.IMPORT_CONCURRENCY)
+        for address in batch:
+            check_res, check_num_tx = checks[address]
+            if not slots:
+                results[address] = f"🚫 over the {MAX_WALLETS} wallet limit"
+            elif not check_res:
+                results[address] = f"🏎️ too busy ({round(check_num_tx, 1)} tx/day, the limit is 50)"
+            else:
+                accepted.append(address)
+                slots -= 1
+    for address in candidates[position:]:
+        results[address] = f"🚫 over the {MAX_WALLETS} wallet limit"
+
+    if accepted:
+        now = datetime.now()
+        updated_at = datetime.utcnow()
+        docs = [
+            {"user_id": str(user_id), "address": address, "datetime": now, "updated_at": updated_at, "status": 'active'}
+            for address in accepted
+        ]
+        if filters:
+            for doc in docs:
+                doc["filters"] = filters
+        failed = {}
+        try:
+            await async_wallets_collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                address = accepted[error['index']]
+                failed[address] = "⏭️ already tracked" if error.get('code') == DUPLICATE_KEY else "⚠️ couldn't be saved"
+        except Exception as e:
+            logger.error(f"Error importing wallets: {str(e)}", exc_info=True)
+            failed = {address: "⚠️ couldn't be saved" for address in accepted}
+
+        for address in accepted:
+            results[address] = failed.get(address, "✅ added")
+            if address not in failed:
+                webhook_sync.notify(address)
+
+        # One webhook update per shard for the whole import
+        try:
+            await webhook_sync.flush()
+        except Exception as e:
+            logger.error(f"Error syncing webhooks after import: {str(e)}", exc_info=True)
+
+    return [(address, results[address]) for address in addresses]
+
+def report_token(address: str) -> str:
+    """Formats an imported token for a Markdown reply; only real addresses go in a code span."""
+    if is_solana_wallet_address(address):
+        return f"`{address}`"
+    # Legacy Markdown can't escape inside a code span, so other tokens are sent escaped as text
+    return ''.join(f"\\{char}" if char in '_*`[' else char for char in address)
+
+def import_report(results: List[Tuple[str, str]]) -> List[str]:
+    """Formats the import results as Telegram messages under the 4096 character limit."""
+    added = sum(1 for _, result in results if result.startswith("✅"))
+    lines = [f"Import done: {added} of {len(results)} wallets added! 🎉\n"]
+    lines += [f"{result}: {report_token(address)}" for address, result in results]
+
+    messages = []
+    current = ""
+    for line in lines:
+        if len(current) + len(line) + 1 > 4000:
+            messages.append(current)
+            current = ""
+        current += line + "\n"
+    messages.append(current)
+    return messages
+
+async def import_wallets_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user_id = update.effective_user.id
+    keyboard = create_keyboard()
 
+    document = update.message.document
+    if document:
+        if document.file_size and document.file_size > config.IMPORT_MAX_FILE_BYTES:
+            await update.message.reply_text("Whoa, that file is a whale! 🐋 Send a smaller list, please.")
+            return IMPORTING_WALLETS
+        file = await document.get_file()
+        text = bytes(await file.download_as_bytearray()).decode('utf-8', errors='ignore')
+    else:
+        text = update.message.text or ""
+
+    addresses = parse_wallet_list(text, config.IMPORT_MAX_ADDRESSES)
+    if not addresses:
+        await update.message.reply_text("Hmm, I couldn't find any addresses in there. Paste them or upload a .txt or .csv file! 📨")
+        return IMPORTING_WALLETS
+
+    await update.message.reply_text(f"Checking {len(addresses)} wallets, hang tight! ⏳")
+    results = await import_wallets(user_id, addresses)
+    messages = import_report(results)
+    for i, message in enumerate(messages):
+        await update.message.reply_text(
+            message,
+            parse_mode='Markdown',
+            reply_markup=keyboard if i == len(messages) - 1 else None
+        )
     return ConversationHandler.END
 
 async def show_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     keyboard = create_keyboard()
 
-    user_wallets = list(wallets_collection.find({
+    user_wallets = await async_wallets_collection.find({
         "user_id": str(user_id),
         "status": "active"
-    }))
+    }, {"address": 1}).to_list(None)
 
     if not user_wallets:
         await update.callback_query.edit_message_text(
@@ -207,19 +411,156 @@ async def show_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             reply_markup=keyboard
         )
 
+async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    enabled = await toggle_digest_async(update.effective_user.id)
+    if enabled:
+        text = (
+            f"📦 Digest mode is on! When more than {config.DIGEST_THRESHOLD} transactions land within "
+            f"{config.DIGEST_WINDOW:g} seconds, I'll bundle the rest into one summary. Send /digest again to turn it off."
+        )
+    else:
+        text = "🔔 Digest mode is off! You'll get every transaction as its own notification. Send /digest to turn it back on."
+    await update.message.reply_text(text)
+
+FILTER_USAGE = (
+    "Filters apply to all your wallets:\n"
+    "/filter types SWAP NFT_SALE - only these transaction types\n"
+    "/filter sources JUPITER TENSOR - only these programs\n"
+    "/filter min_sol 0.5 - only when your wallet moves at least 0.5 SOL\n"
+    "/filter min_token 100 - only when your wallet moves at least 100 tokens\n"
+    "/filter types - without values, removes that filter\n"
+    "/filter clear - removes all filters\n"
+    "/mute <address> and /unmute <address> - skip transactions involving an account\n"
+    "/filters - shows your filters"
+)
+
+async def show_filters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = describe(await get_filters_async(update.effective_user.id))
+    if lines:
+        text = "🎛️ You only get notified about transactions matching all of these:\n" + "\n".join(lines)
+    else:
+        text = "🎛️ No filters yet, you get every transaction."
+    await update.message.reply_text(f"{text}\n\n{FILTER_USAGE}")
+
+async def set_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if context.args and context.args[0].lower() == 'clear':
+        update_doc = {"$unset": {"filters": ""}}
+    else:
+        try:
+            field, value = parse_filter(context.args)
+        except ValueError as e:
+            await update.message.reply_text(f"Hmm, I couldn't read that filter ({str(e)}). 🤔\n\n{FILTER_USAGE}")
+            return
+        if value:
+            update_doc = {"$set": {f"filters.{field}": value}}
+        else:
+            update_doc = {"$unset": {f"filters.{field}": ""}}
+
+    if not await update_filters_async(user_id, update_doc):
+        await update.message.reply_text("Add a wallet first, then you can filter its notifications! 😉")
+        return
+    await show_filters(update, context)
+
+async def mute_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    muting = update.message.text.startswith('/mute')
+    if len(context.args) != 1 or not is_solana_wallet_address(context.args[0]):
+        await update.message.reply_text("Send the account along with the command, like /mute <address>. 📨")
+        return
+
+    address = context.args[0]
+    if muting:
+        update_doc = {"$addToSet": {"filters.muted": address}}
+    else:
+        update_doc = {"$pull": {"filters.muted": address}}
+    if not await update_filters_async(update.effective_user.id, update_doc):
+        await update.message.reply_text("Add a wallet first, then you can filter its notifications! 😉")
+        return
+    if muting:
+        await update.message.reply_text(f"🔇 Transactions involving {address} won't bother you anymore.")
+    else:
+        await update.message.reply_text(f"🔊 {address} is unmuted.")
+
+def noisy_wallet_message(report: dict) -> str:
+    address = report["_id"]
+    if report.get("action") == "sample":
+        outcome = f"you'll only hear about one in {config.ACTIVITY_SAMPLE_EVERY} of its transactions"
+    elif report.get("action") == "summarize":
+        outcome = f"you'll get a summary every {config.ACTIVITY_SUMMARY_INTERVAL / 60:g} minutes instead of every transaction"
+    else:
+        outcome = "its notifications are paused"
+    return (
+        f"🚨 Your wallet {address[:4]}...{address[-4:]} is on fire: {report.get('count', 0)} transactions in the last "
+        f"{report.get('window_minutes', config.ACTIVITY_WINDOW_MINUTES)} minutes! To keep things running smoothly for everyone, "
+        f"{outcome} until it calms down. 🧯"
+    )
+
+async def notify_noisy_wallets(application: Application) -> None:
+    """Tells users when app.py reports one of their wallets as too active."""
+    while True:
+        try:
+            reports = await async_noisy_wallets_collection.find({"notified": False}).to_list(100)
+            for report in reports:
+                users = await async_wallets_collection.distinct("user_id", {"address": report["_id"], "status": "active"})
+                for user_id in users:
+                    try:
+                        await application.bot.send_message(chat_id=int(user_id), text=noisy_wallet_message(report))
+                    except Exception as e:
+                        logger.error(f"Error telling {user_id} about noisy wallet {report['_id']}: {str(e)}")
+                # Scoped to this report, a newer one is sent on the next round
+                await async_noisy_wallets_collection.update_one(
+                    {"_id": report["_id"], "flagged_at": report.get("flagged_at")},
+                    {"$set": {"notified": True}}
+                )
+        except Exception as e:
+            logger.error(f"Error checking noisy wallets: {str(e)}", exc_info=True)
+        await asyncio.sleep(config.ACTIVITY_NOTIFY_INTERVAL)
+
+async def post_init(application: Application) -> None:
+    await webhook_sync.start()
+    application.bot_data["noisy_wallets_task"] = asyncio.create_task(notify_noisy_wallets(application))
+
+async def post_shutdown(application: Application) -> None:
+    task = application.bot_data.get("noisy_wallets_task")
+    if task is not None:
+        task.cancel()
+    await webhook_sync.stop()
+    await close_clients()
+
 def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_callback)],
+        entry_points=[CallbackQueryHandler(button_callback), CommandHandler("import", import_wallets_start)],
         states={
-            ADDING_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_wallet_finish)],
-            DELETING_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_wallet_finish)],
+            # Non-blocking, so one user's Helius and Mongo round trips don't hold up everyone else's updates
+            ADDING_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_wallet_finish, block=False)],
+            DELETING_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_wallet_finish, block=False)],
+            IMPORTING_WALLETS: [
+                MessageHandler(
+                    (filters.TEXT & ~filters.COMMAND)
+                    | filters.Document.TXT
+                    | filters.Document.MimeType('text/csv')
+                    | filters.Document.FileExtension('csv'),
+                    import_wallets_finish,
+                    block=False
+                )
+            ],
         },
         fallbacks=[CallbackQueryHandler(back, pattern='^back$')],
     )
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("digest", toggle_digest, block=False))
+    application.add_handler(CommandHandler("filters", show_filters, block=False))
+    application.add_handler(CommandHandler("filter", set_filter, block=False))
+    application.add_handler(CommandHandler(["mute", "unmute"], mute_account, block=False))
     application.add_handler(conv_handler)
 
     application.run_polling()
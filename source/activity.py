@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+DELIVER = 'deliver'
+SKIP = 'skip'
+SUMMARY = 'summary'
+ACTIONS = ('throttle', 'sample', 'summarize')
+
+
+class _Window:
+    """Ring buffer of per-minute transaction counts for one address."""
+
+    __slots__ = ('counts', 'minute', 'total', 'noisy', 'skipped', 'seen', 'reported', 'summarized')
+
+    def __init__(self, size: int, minute: int):
+        self.counts = array('H', bytes(2 * size))
+        self.minute = minute
+        self.total = 0
+        self.noisy = False
+        self.skipped = 0
+        self.seen = 0
+        self.reported = 0.0
+        self.summarized = 0.0
+
+    def advance(self, minute: int) -> None:
+        """Zeroes the buckets of the minutes that passed since the last update."""
+        size = len(self.counts)
+        if minute - self.minute >= size:
+            self.counts = array('H', bytes(2 * size))
+            self.total = 0
+        else:
+            for m in range(self.minute + 1, minute + 1):
+                self.total -= self.counts[m % size]
+                self.counts[m % size] = 0
+        self.minute = max(self.minute, minute)
+
+    def add(self) -> None:
+        i = self.minute % len(self.counts)
+        if self.counts[i] < 0xFFFF:
+            self.counts[i] += 1
+            self.total += 1
+
+
+class ActivityTracker:
+    """
+    Sliding-window transaction counts for every tracked address that shows
+    up in webhook events, kept in fixed-size per-minute ring buffers.
+    An address with more than `limit` transactions in the last
+    `window_minutes` is noisy until its count falls back under the limit.
+    Noisy addresses are either throttled (nothing is delivered), sampled
+    (every `sample_every`-th transaction is) or summarized (a count is
+    delivered every `summary_interval` seconds instead). They are also
+    upserted into the `noisy_wallets` collection, at most once per
+    `report_interval`, for the bot to warn their users and refuse them at
+    add time.
+    Args:
+        collection: The pymongo noisy_wallets collection.
+        window_minutes (int): Length of the sliding window.
+        limit (int): Transactions allowed per window.
+        action (str): 'throttle', 'sample' or 'summarize'.
+        sample_every (int): One transaction in this many is delivered when sampling.
+        summary_interval (float): Seconds between summaries when summarizing.
+        report_interval (float): Seconds between updates of a noisy address's report.
+        max_addresses (int): Idle addresses are forgotten past this many.
+    """
+
+    def __init__(self, collection, window_minutes: int = 60, limit: int = 20, action: str = 'throttle',
+                 sample_every: int = 10, summary_interval: float = 900, report_interval: float = 60,
+                 max_addresses: int = 200000):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown activity action {action!r}, expected one of {', '.join(ACTIONS)}")
+        self.collection = collection
+        self.window_minutes = window_minutes
+        self.limit = limit
+        self.action = action
+        self.sample_every = sample_every
+        self.summary_interval = summary_interval
+        self.report_interval = report_interval
+        self.max_addresses = max_addresses
+
+        self._lock = threading.Lock()
+        self._windows: Dict[str, _Window] = {}
+
+    def _prune(self, minute: int) -> None:
+        self._windows = {
+            address: window for address, window in self._windows.items()
+            if window.noisy or minute - window.minute < self.window_minutes
+        }
+
+    def record(self, address: str, now: Optional[float] = None) -> str:
+        """
+        Counts one transaction of a tracked address and decides what to deliver.
+        Args:
+            address (str): The tracked address.
+            now (float, optional): Unix time of the transaction, defaults to now.
+        Returns:
+            str: DELIVER, SKIP, or SUMMARY when a summary should be sent instead.
+        """
+        now = time.time() if now is None else now
+        minute = int(now // 60)
+        report = None
+        with self._lock:
+            window = self._windows.get(address)
+            if window is None:
+                if len(self._windows) >= self.max_addresses:
+                    self._prune(minute)
+                window = self._windows[address] = _Window(self.window_minutes, minute)
+            window.advance(minute)
+            window.add()
+
+            was_noisy = window.noisy
+            window.noisy = window.total > self.limit
+            if not window.noisy:
+                if was_noisy:
+                    logger.info(f"{address} is back under {self.limit} transactions per {self.window_minutes} minutes")
+                return DELIVER
+
+            if not was_noisy:
+                logger.warning(f"{address} made {window.total} transactions in {self.window_minutes} minutes, applying {self.action}")
+                window.seen = window.skipped = 0
+                window.summarized = now
+            window.seen += 1
+            if not was_noisy or now - window.reported >= self.report_interval:
+                window.reported = now
+                report = (window.total, not was_noisy)
+
+            decision = SKIP
+            if self.action == 'sample' and window.seen % self.sample_every == 1 % self.sample_every:
+                decision = DELIVER
+            elif self.action == 'summarize' and now - window.summarized >= self.summary_interval:
+                window.summarized = now
+                decision = SUMMARY
+            if decision == SKIP:
+                window.skipped += 1
+            metrics.ACTIVITY.inc(decision=decision)
+
+        if report is not None:
+            self._report(address, *report)
+        return decision
+
+    def summary(self, address: str) -> Tuple[int, int]:
+        """
+        Returns the address's transactions in the window and the notifications
+        skipped since the last summary, and starts counting skips afresh.
+        """
+        with self._lock:
+            window = self._windows.get(address)
+            if window is None:
+                return 0, 0
+            skipped, window.skipped = window.skipped, 0
+            return window.total, skipped
+
+    def _report(self, address: str, total: int, flagged: bool) -> None:
+        now = datetime.utcnow()
+        update = {
+            '$set': {
+                'count': total,
+                'window_minutes': self.window_minutes,
+                'rate_per_day': total * 1440 / self.window_minutes,
+                'action': self.action,
+                'last_seen': now,
+            },
+            '$setOnInsert': {'first_seen': now},
+        }
+        if flagged:
+            # A new episode, the bot tells the wallet's users again
+            update['$set']['notified'] = False
+            update['$set']['flagged_at'] = now
+        try:
+            self.collection.update_one({'_id': address}, update, upsert=True)
+        except PyMongoError as e:
+            logger.error(f"Error reporting noisy wallet {address}: {str(e)}")
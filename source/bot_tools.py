@@ -1,13 +1,17 @@
-from pymongo import MongoClient
-import requests
+from pymongo import AsyncMongoClient
+import asyncio
+import hashlib
+import os
+import re
 from datetime import datetime
 import source.config as config
+from source import http_client
 import logging
-from typing import Tuple, List, Optional
+from typing import Dict, Iterable, Tuple, List, Optional
 
 # Set up logging
 logging.basicConfig(
-    filename='bot.log',
+    filename=os.path.join(config.LOG_DIR, 'bot.log'),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
@@ -17,15 +21,22 @@ logger = logging.getLogger(__name__)
 MONGODB_URI = config.MONGODB_URI
 BOT_TOKEN = config.BOT_TOKEN
 HELIUS_KEY = config.HELIUS_KEY
+HELIUS_API_URL = config.HELIUS_API_URL
 HELIUS_WEBHOOK_URL = config.HELIUS_WEBHOOK_URL
 HELIUS_WEBHOOK_ID = config.HELIUS_WEBHOOK_ID
 
-# Database setup
-client = MongoClient(MONGODB_URI)
-db = client.sol_wallets
-wallets_collection = db.wallets_test
+# Database setup, on the bot's event loop
+async_client = AsyncMongoClient(MONGODB_URI)
+async_wallets_collection = async_client.sol_wallets[config.WALLETS_COLLECTION]
+async_users_collection = async_client.sol_wallets.users
+async_noisy_wallets_collection = async_client.sol_wallets.noisy_wallets
 
-def get_webhook(webhook_id: str) -> Tuple[bool, Optional[str], Optional[List[str]]]:
+async def close_clients() -> None:
+    """Closes the shared async HTTP and Mongo clients."""
+    await http_client.close_async_client()
+    await async_client.close()
+
+async def get_webhook_async(webhook_id: str) -> Tuple[bool, Optional[str], Optional[List[str]]]:
     """
     Fetches the current webhook configuration from Helius.
     Args:
@@ -37,8 +48,8 @@ def get_webhook(webhook_id: str) -> Tuple[bool, Optional[str], Optional[List[str
             - List of account addresses (List[str] or None)
     """
     try:
-        url = f"https://api.helius.xyz/v0/webhooks/{webhook_id}?api-key={HELIUS_KEY}"
-        r = requests.get(url, timeout=10)
+        url = f"{HELIUS_API_URL}/v0/webhooks/{webhook_id}?api-key={HELIUS_KEY}"
+        r = await http_client.request_async('GET', url, 'helius.webhooks', timeout=10)
         r.raise_for_status()
         data = r.json()
         return True, data['webhookID'], data['accountAddresses']
@@ -46,92 +57,176 @@ def get_webhook(webhook_id: str) -> Tuple[bool, Optional[str], Optional[List[str
         logger.error(f"Error getting webhook: {str(e)}", exc_info=True)
         return False, None, None
 
-def add_webhook(user_id: int, user_wallet: str, webhook_id: str, addresses: List[str]) -> bool:
+async def list_webhooks_async() -> Tuple[bool, List[dict]]:
     """
-    Adds a wallet address to the Helius webhook.
-    Args:
-        user_id (int): The ID of the user adding the wallet.
-        user_wallet (str): The wallet address to add.
-        webhook_id (str): The ID of the webhook to update.
-        addresses (List[str]): The current list of addresses in the webhook.
+    Lists every webhook of the Helius account.
     Returns:
-        bool: True if the update was successful, False otherwise.
+        Tuple[bool, List[dict]]: Whether the request succeeded, and the webhooks
+            with their 'webhookID', 'webhookURL' and 'accountAddresses'.
     """
-    if user_wallet in addresses:
-        logger.info('Wallet already exists in webhook, returning true')
-        return True
-
-    addresses.append(user_wallet)
-    data = {
-        "webhookURL": HELIUS_WEBHOOK_URL,
-        "accountAddresses": addresses,
-        "transactionTypes": ["Any"],
-        "webhookType": "enhanced",
-    }
-
     try:
-        url = f"https://api.helius.xyz/v0/webhooks/{webhook_id}?api-key={HELIUS_KEY}"
-        r = requests.put(url, json=data, timeout=15)
+        url = f"{HELIUS_API_URL}/v0/webhooks?api-key={HELIUS_KEY}"
+        r = await http_client.request_async('GET', url, 'helius.webhooks', timeout=10)
         r.raise_for_status()
-        return True
+        return True, r.json()
     except Exception as e:
-        logger.error(f"Error adding wallet to webhook: {str(e)}", exc_info=True)
-        return False
+        logger.error(f"Error listing webhooks: {str(e)}", exc_info=True)
+        return False, []
+
+def webhook_for_address(address: str, webhook_ids: List[str]) -> str:
+    """
+    Picks the webhook shard an address belongs to (rendezvous hashing).
+    Adding a shard only moves the addresses that now rank it highest.
+    Args:
+        address (str): The wallet address.
+        webhook_ids (List[str]): The pool of webhook IDs.
+    Returns:
+        str: The ID of the webhook that should track the address.
+    """
+    def score(webhook_id: str) -> bytes:
+        return hashlib.sha1(f"{webhook_id}:{address}".encode()).digest()
+
+    return max(webhook_ids, key=score)
 
-def delete_webhook(user_id: int, user_wallet: str, webhook_id: str, addresses: List[str]) -> bool:
+async def put_webhook_async(webhook_id: str, addresses: List[str]) -> bool:
     """
-    Removes a wallet address from the Helius webhook.
+    Replaces the address list of a Helius webhook.
     Args:
-        user_id (int): The ID of the user deleting the wallet.
-        user_wallet (str): The wallet address to remove.
         webhook_id (str): The ID of the webhook to update.
-        addresses (List[str]): The current list of addresses in the webhook.
+        addresses (List[str]): The full list of addresses the webhook should track.
     Returns:
         bool: True if the update was successful, False otherwise.
     """
-    if user_wallet not in addresses:
-        logger.info('Wallet not found in webhook, returning true')
+    try:
+        url = f"{HELIUS_API_URL}/v0/webhooks/{webhook_id}?api-key={HELIUS_KEY}"
+        r = await http_client.request_async('PUT', url, 'helius.webhooks', json=_webhook_body(addresses), timeout=15)
+        r.raise_for_status()
         return True
+    except Exception as e:
+        logger.error(f"Error updating webhook: {str(e)}", exc_info=True)
+        return False
 
-    addresses.remove(user_wallet)
-    data = {
+def _webhook_body(addresses: List[str]) -> dict:
+    return {
         "webhookURL": HELIUS_WEBHOOK_URL,
         "accountAddresses": addresses,
         "transactionTypes": ["Any"],
         "webhookType": "enhanced",
     }
 
-    try:
-        url = f"https://api.helius.xyz/v0/webhooks/{webhook_id}?api-key={HELIUS_KEY}"
-        r = requests.put(url, json=data, timeout=15)
-        r.raise_for_status()
-        return True
-    except Exception as e:
-        logger.error(f"Error deleting wallet from webhook: {str(e)}", exc_info=True)
-        return False
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BASE58_INDEX = {char: i for i, char in enumerate(BASE58_ALPHABET)}
+
+def b58decode(value: str) -> Optional[bytes]:
+    """
+    Decodes a base58 string.
+    Args:
+        value (str): The base58 string.
+    Returns:
+        Optional[bytes]: The decoded bytes, or None if `value` isn't valid base58.
+    """
+    number = 0
+    for char in value:
+        digit = BASE58_INDEX.get(char)
+        if digit is None:
+            return None
+        number = number * 58 + digit
+
+    # Every leading '1' stands for a leading zero byte
+    zeros = len(value) - len(value.lstrip('1'))
+    return b'\0' * zeros + number.to_bytes((number.bit_length() + 7) // 8, 'big')
 
 def is_solana_wallet_address(address: str) -> bool:
     """
-    Validates a Solana wallet address.
+    Validates a Solana wallet address: base58 that decodes to a 32 byte public key.
     Args:
         address (str): The address to validate.
     Returns:
         bool: True if the address is valid, False otherwise.
     """
-    base58_chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
-    return len(address) == 44 and all(char in base58_chars for char in address)
+    if not 32 <= len(address) <= 44:
+        return False
+    decoded = b58decode(address)
+    return decoded is not None and len(decoded) == 32
 
-def wallet_count_for_user(user_id: int) -> int:
+def parse_wallet_list(text: str, max_addresses: int) -> List[str]:
+    """
+    Splits a pasted list or CSV into unique candidate addresses, in order.
+    Args:
+        text (str): Addresses separated by whitespace, commas or semicolons.
+        max_addresses (int): Addresses past this number are dropped.
+    Returns:
+        List[str]: The candidates, not validated yet.
+    """
+    seen = {}
+    for token in re.split(r'[\s,;]+', text):
+        token = token.strip('\'"`')
+        if token and token not in seen:
+            seen[token] = None
+            if len(seen) >= max_addresses:
+                break
+    return list(seen)
+
+async def wallet_count_for_user_async(user_id: int, limit: int = 0) -> int:
     """
     Counts the number of active wallets for a user.
     Args:
         user_id (int): The ID of the user.
+        limit (int, optional): Stop counting at this number, 0 counts them all.
     Returns:
         int: The number of active wallets.
     """
-    return wallets_collection.count_documents({"user_id": str(user_id), "status": "active"})
+    # $limit must be positive, so it is only passed when set
+    options = {"limit": limit} if limit else {}
+    return await async_wallets_collection.count_documents({"user_id": str(user_id), "status": "active"}, **options)
+
+async def get_filters_async(user_id: int) -> dict:
+    """
+    Returns a user's notification filters, stored on each of their wallets.
+    Args:
+        user_id (int): The Telegram user ID.
+    Returns:
+        dict: The filters, empty if the user has none.
+    """
+    wallet = await async_wallets_collection.find_one(
+        {"user_id": str(user_id), "status": "active", "filters": {"$exists": True}},
+        {"filters": 1}
+    )
+    return (wallet or {}).get("filters") or {}
 
-def check_wallet_transactions(wallet: str) -> Tuple[bool, float]:
+async def update_filters_async(user_id: int, update: dict) -> int:
+    """
+    Applies an update to the filters on all of a user's wallets, which the
+    ingestion index picks up from the collection.
+    Args:
+        user_id (int): The Telegram user ID.
+        update (dict): A Mongo update on the 'filters' field, e.g. {"$set": {"filters.min_sol": 1.0}}.
+    Returns:
+        int: The number of wallets updated.
+    """
+    # updated_at lets the ingestion index poll for the change
+    update = {**update, "$set": {**update.get("$set", {}), "updated_at": datetime.utcnow()}}
+    result = await async_wallets_collection.update_many({"user_id": str(user_id), "status": "active"}, update)
+    return result.matched_count
+
+async def toggle_digest_async(user_id: int) -> bool:
+    """
+    Switches a user's burst digests on or off.
+    Args:
+        user_id (int): The Telegram user ID.
+    Returns:
+        bool: True if digests are now on.
+    """
+    user = await async_users_collection.find_one({"_id": str(user_id)}, {"digest": 1})
+    enabled = not (user or {}).get("digest", config.DIGEST_DEFAULT)
+    await async_users_collection.update_one(
+        {"_id": str(user_id)},
+        {"$set": {"digest": enabled, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return enabled
+
+async def check_wallet_transactions_async(wallet: str) -> Tuple[bool, float]:
     """
     Checks the transaction rate of a wallet.
     Args:
@@ -139,26 +234,55 @@ def check_wallet_transactions(wallet: str) -> Tuple[bool, float]:
     Returns:
         Tuple[bool, float]: A tuple containing:
             - True if the wallet is valid (transaction rate <= 50/day), False otherwise.
-            - The calculated transaction rate per day.
+            - The calculated transaction rate per day, taken from the noisy wallet
+              reports when app.py has already flagged the wallet.
     """
+    # Tracked wallets are counted continuously by app.py, which beats sampling one page
+    try:
+        noisy = await async_noisy_wallets_collection.find_one({"_id": wallet}, {"rate_per_day": 1})
+    except Exception as e:
+        logger.error(f"Error reading noisy wallets: {str(e)}")
+        noisy = None
+    if noisy:
+        return False, noisy.get("rate_per_day", 0)
+
     try:
-        url = f'https://api.helius.xyz/v0/addresses/{wallet}/raw-transactions?api-key={HELIUS_KEY}'
-        r = requests.get(url, timeout=15)
+        url = f'{HELIUS_API_URL}/v0/addresses/{wallet}/raw-transactions?api-key={HELIUS_KEY}'
+        r = await http_client.request_async('GET', url, 'helius.raw_transactions', timeout=15)
         r.raise_for_status()
-        transactions = r.json()
+        return _transaction_rate(r.json())
+    except Exception as e:
+        logger.error(f"Error checking wallet transactions: {str(e)}", exc_info=True)
+        return True, 0
 
-        if len(transactions) < 10:
-            return True, 0
+async def check_wallets_transactions_async(wallets: Iterable[str], concurrency: int) -> Dict[str, Tuple[bool, float]]:
+    """
+    Checks the transaction rate of many wallets, at most `concurrency` at a time.
+    Args:
+        wallets (Iterable[str]): The wallet addresses to check.
+        concurrency (int): Maximum number of Helius requests in flight.
+    Returns:
+        Dict[str, Tuple[bool, float]]: `check_wallet_transactions_async` results by wallet.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(wallet: str) -> Tuple[bool, float]:
+        async with semaphore:
+            return await check_wallet_transactions_async(wallet)
 
-        latest_tx_time = datetime.utcfromtimestamp(transactions[-1]['blockTime'])
-        time_diff = (datetime.utcnow() - latest_tx_time).total_seconds()
+    wallets = list(wallets)
+    results = await asyncio.gather(*(check(wallet) for wallet in wallets))
+    return dict(zip(wallets, results))
 
-        if time_diff == 0:
-            return True, 0
+def _transaction_rate(transactions: list) -> Tuple[bool, float]:
+    if len(transactions) < 10:
+        return True, 0
 
-        daily_rate = len(transactions) / time_diff * 86400
-        return daily_rate <= 50, round(daily_rate, 1)
+    latest_tx_time = datetime.utcfromtimestamp(transactions[-1]['blockTime'])
+    time_diff = (datetime.utcnow() - latest_tx_time).total_seconds()
 
-    except Exception as e:
-        logger.error(f"Error checking wallet transactions: {str(e)}", exc_info=True)
+    if time_diff == 0:
         return True, 0
+
+    daily_rate = len(transactions) / time_diff * 86400
+    return daily_rate <= 50, round(daily_rate, 1)
@@ -4,4 +4,139 @@ MONGODB_URI = os.getenv("MONGODB_URI")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 HELIUS_KEY = os.getenv("HELIUS_KEY")
 HELIUS_WEBHOOK_URL = os.getenv("HELIUS_WEBHOOK_URL")
-HELIUS_WEBHOOK_ID = os.getenv("HELIUS_WEBHOOK_ID")
\ No newline at end of file
+HELIUS_WEBHOOK_ID = os.getenv("HELIUS_WEBHOOK_ID")
+# Pool of webhooks the tracked addresses are sharded across, comma separated
+HELIUS_WEBHOOK_IDS = [i.strip() for i in os.getenv("HELIUS_WEBHOOK_IDS", HELIUS_WEBHOOK_ID or "").split(",") if i.strip()]
+HELIUS_WEBHOOK_MAX_ADDRESSES = int(os.getenv("HELIUS_WEBHOOK_MAX_ADDRESSES", "100000"))
+# Empty webhooks dropped from HELIUS_WEBHOOK_IDS that this service managed before
+HELIUS_RETIRE_REMOVED_WEBHOOKS = os.getenv("HELIUS_RETIRE_REMOVED_WEBHOOKS", "0") == "1"
+
+# Service endpoints, overridable to point at local stand-ins (see bench/)
+HELIUS_API_URL = os.getenv("HELIUS_API_URL", "https://api.helius.xyz")
+HELIUS_RPC_URL = os.getenv("HELIUS_RPC_URL", "https://rpc.helius.xyz")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+# Directory of the wallet.log, bot.log and worker.log files
+LOG_DIR = os.getenv("LOG_DIR", ".")
+
+# Webhook dispatch
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+DISPATCH_ENQUEUE_TIMEOUT = float(os.getenv("DISPATCH_ENQUEUE_TIMEOUT", "2"))
+# Threads for the dispatch loop's blocking Mongo and image calls (outbox, delivery)
+DISPATCH_THREADS = int(os.getenv("DISPATCH_THREADS", "32"))
+
+# Internal /metrics and /traces server, kept off the public webhook bind; port 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9103"))
+
+# Wallets collection in the sol_wallets database, shared by the app, bot and worker
+WALLETS_COLLECTION = os.getenv("WALLETS_COLLECTION", "wallets")
+
+# Subscriber index
+SUBSCRIBER_CHANGE_STREAMS = os.getenv("SUBSCRIBER_CHANGE_STREAMS", "1") == "1"
+SUBSCRIBER_POLL_INTERVAL = float(os.getenv("SUBSCRIBER_POLL_INTERVAL", "10"))
+SUBSCRIBER_CHECK_INTERVAL = float(os.getenv("SUBSCRIBER_CHECK_INTERVAL", "600"))
+
+# Telegram file_id cache
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "10000"))
+FILE_ID_CACHE_TTL = float(os.getenv("FILE_ID_CACHE_TTL", str(7 * 86400)))
+
+# NFT metadata cache
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "50000"))
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "86400"))
+METADATA_NEGATIVE_TTL = float(os.getenv("METADATA_NEGATIVE_TTL", "3600"))
+
+# Telegram delivery
+DELIVERY_RATE = float(os.getenv("DELIVERY_RATE", "30"))
+DELIVERY_CHAT_INTERVAL = float(os.getenv("DELIVERY_CHAT_INTERVAL", "1"))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "16"))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "5"))
+
+# Message history write-behind
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+HISTORY_MAX_BUFFER = int(os.getenv("HISTORY_MAX_BUFFER", "50000"))
+HISTORY_SPILL_PATH = os.getenv("HISTORY_SPILL_PATH", "messages_spill.jsonl")
+
+# Helius webhook sync
+WEBHOOK_SYNC_WINDOW = float(os.getenv("WEBHOOK_SYNC_WINDOW", "2"))
+WEBHOOK_RECONCILE_INTERVAL = float(os.getenv("WEBHOOK_RECONCILE_INTERVAL", "600"))
+
+# Delivery deduplication
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "100000"))
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "86400"))
+
+# NFT image preparation
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "40000000"))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "10"))
+IMAGE_PROCESS_TIMEOUT = float(os.getenv("IMAGE_PROCESS_TIMEOUT", "10"))
+
+# Shared HTTP client
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "8"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+
+# Schema bootstrap
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "1") == "1"
+# Refuse to start when a hot query would scan a whole collection, instead of logging it
+SCHEMA_CHECK_STRICT = os.getenv("SCHEMA_CHECK_STRICT", "0") == "1"
+SCHEMA_MIGRATION_WAIT = float(os.getenv("SCHEMA_MIGRATION_WAIT", "60"))
+SCHEMA_MIGRATION_TIMEOUT = float(os.getenv("SCHEMA_MIGRATION_TIMEOUT", "3600"))
+
+# Wallet limits and bulk import
+MAX_WALLETS_PER_USER = int(os.getenv("MAX_WALLETS_PER_USER", "5"))
+IMPORT_MAX_ADDRESSES = int(os.getenv("IMPORT_MAX_ADDRESSES", "200"))
+IMPORT_MAX_FILE_BYTES = int(os.getenv("IMPORT_MAX_FILE_BYTES", str(256 * 1024)))
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "8"))
+
+# Delivery outbox
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "60"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_LOOPS = int(os.getenv("OUTBOX_LOOPS", "4"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+# Attempts to store a payload's messages before their dedup claims are released
+OUTBOX_ENQUEUE_RETRIES = int(os.getenv("OUTBOX_ENQUEUE_RETRIES", "3"))
+# Seconds between refreshes of the outbox depth metric
+OUTBOX_DEPTH_INTERVAL = float(os.getenv("OUTBOX_DEPTH_INTERVAL", "15"))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", str(3 * 86400)))
+# Run a delivery worker inside app.py, set to 0 when only worker.py processes deliver
+OUTBOX_INLINE_WORKER = os.getenv("OUTBOX_INLINE_WORKER", "1") == "1"
+
+# Burst digests: past DIGEST_THRESHOLD notifications within DIGEST_WINDOW seconds,
+# a chat's notifications are merged into one digest. Users opt in with /digest.
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "10"))
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", "3"))
+DIGEST_MAX_LINES = int(os.getenv("DIGEST_MAX_LINES", "30"))
+# Digests for users who never used /digest
+DIGEST_DEFAULT = os.getenv("DIGEST_DEFAULT", "0") == "1"
+DIGEST_PREFERENCE_TTL = float(os.getenv("DIGEST_PREFERENCE_TTL", "60"))
+
+# Batched NFT metadata lookups: misses from all in-flight events are collected
+# for RESOLVER_WINDOW seconds, then sent as one token-metadata / getAssetBatch call
+RESOLVER_WINDOW = float(os.getenv("RESOLVER_WINDOW", "0.005"))
+RESOLVER_MINT_BATCH = int(os.getenv("RESOLVER_MINT_BATCH", "100"))
+RESOLVER_ASSET_BATCH = int(os.getenv("RESOLVER_ASSET_BATCH", "100"))
+RESOLVER_JSON_WORKERS = int(os.getenv("RESOLVER_JSON_WORKERS", "8"))
+RESOLVER_TIMEOUT = float(os.getenv("RESOLVER_TIMEOUT", "30"))
+
+# Noisy wallet tracking: past ACTIVITY_LIMIT transactions in ACTIVITY_WINDOW_MINUTES,
+# a wallet's notifications are throttled, sampled or summarized (ACTIVITY_ACTION)
+ACTIVITY_WINDOW_MINUTES = int(os.getenv("ACTIVITY_WINDOW_MINUTES", "60"))
+ACTIVITY_LIMIT = int(os.getenv("ACTIVITY_LIMIT", "20"))
+ACTIVITY_ACTION = os.getenv("ACTIVITY_ACTION", "summarize")
+ACTIVITY_SAMPLE_EVERY = int(os.getenv("ACTIVITY_SAMPLE_EVERY", "10"))
+ACTIVITY_SUMMARY_INTERVAL = float(os.getenv("ACTIVITY_SUMMARY_INTERVAL", "900"))
+ACTIVITY_REPORT_INTERVAL = float(os.getenv("ACTIVITY_REPORT_INTERVAL", "60"))
+# How long a wallet stays reported, and refused by the bot, after it calms down
+ACTIVITY_REPORT_TTL = float(os.getenv("ACTIVITY_REPORT_TTL", "86400"))
+ACTIVITY_MAX_ADDRESSES = int(os.getenv("ACTIVITY_MAX_ADDRESSES", "200000"))
+# Seconds between the bot's checks for newly reported wallets
+ACTIVITY_NOTIFY_INTERVAL = float(os.getenv("ACTIVITY_NOTIFY_INTERVAL", "60"))
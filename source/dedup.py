@@ -0,0 +1,86 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Iterable, Set, Tuple
+
+from cachetools import TTLCache
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class DeliveryDeduplicator:
+    """
+    Drops repeated (signature, user) deliveries caused by Helius retries.
+    A bounded in-memory set answers most repeats; a Mongo collection with a
+    unique (signature, user) index and a TTL catches the rest, including
+    repeats across restarts and across processes.
+    Args:
+        collection: The pymongo collection holding claimed deliveries.
+        max_size (int): Maximum number of pairs remembered in memory.
+        ttl (float): Seconds a pair is remembered in memory. The Mongo indexes
+            are created by source/schema.py, with DEDUP_TTL.
+    """
+
+    def __init__(self, collection, max_size: int = 100000, ttl: float = 86400):
+        self.collection = collection
+        self._seen = TTLCache(maxsize=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def claim(self, pairs: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """
+        Claims deliveries, returning only those not seen before.
+        If Mongo can't be reached the pairs are let through: a duplicate
+        notification is better than a lost one.
+        Args:
+            pairs (Iterable[Tuple[str, str]]): (signature, user) pairs.
+        Returns:
+            Set[Tuple[str, str]]: The pairs that are new and should be delivered.
+        """
+        with self._lock:
+            candidates = [pair for pair in dict.fromkeys(pairs) if pair not in self._seen]
+        if not candidates:
+            return set()
+
+        now = datetime.utcnow()
+        docs = [{'signature': signature, 'user': user, 'created_at': now} for signature, user in candidates]
+        duplicates = set()
+        # Pairs whose claim wasn't stored are let through but not remembered
+        failed = set()
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY:
+                    duplicates.add(candidates[error['index']])
+                else:
+                    failed.add(candidates[error['index']])
+        except PyMongoError as e:
+            logger.error(f"Error claiming deliveries, letting them through: {str(e)}")
+            failed = set(candidates)
+
+        with self._lock:
+            for pair in candidates:
+                if pair not in failed:
+                    self._seen[pair] = True
+        return set(candidates) - duplicates
+
+    def release(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        """
+        Gives claimed deliveries back, e.g. when they couldn't be queued, so a
+        later redelivery of the same transaction isn't dropped as a duplicate.
+        Args:
+            pairs (Iterable[Tuple[str, str]]): (signature, user) pairs.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        if not pairs:
+            return
+        with self._lock:
+            for pair in pairs:
+                self._seen.pop(pair, None)
+        try:
+            self.collection.delete_many({'$or': [{'signature': signature, 'user': user} for signature, user in pairs]})
+        except PyMongoError as e:
+            logger.error(f"Error releasing {len(pairs)} claimed deliveries: {str(e)}")
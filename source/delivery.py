@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Async token bucket shared by every send.
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float, optional): Maximum burst size, defaults to `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Stops handing out tokens for `seconds`, e.g. after a flood control error."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        # The lock keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class DeliveryEngine:
+    """
+    Concurrent, rate limited Telegram delivery on one shared Bot client.
+    Sends go through a global token bucket and a per-chat pacing slot. Flood
+    control (RetryAfter) pauses the bucket and reschedules the send, transient
+    network errors are retried with jittered exponential backoff.
+    Args:
+        bot: The shared telegram Bot.
+        file_ids: FileIdCache used to send already uploaded images by reference.
+        get_image (Callable[[str], BytesIO]): Downloads and prepares an image for upload.
+        rate (float): Global messages per second.
+        chat_interval (float): Minimum seconds between two messages to the same chat.
+        concurrency (int): Maximum number of requests in flight.
+        max_retries (int): Retries for transient network errors (and, separately, for flood control).
+        base_delay (float): Backoff base in seconds.
+        max_delay (float): Backoff cap in seconds.
+    """
+
+    def __init__(
+        self,
+        bot,
+        file_ids,
+        get_image: Callable,
+        rate: float = 30,
+        chat_interval: float = 1.0,
+        concurrency: int = 16,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30,
+    ):
+        self.bot = bot
+        self.file_ids = file_ids
+        self.get_image = get_image
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.bucket = TokenBucket(rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_slot: Dict[int, float] = {}
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+        # Sends holding or waiting for each upload lock, it's dropped when the last one leaves
+        self._upload_users: Dict[str, int] = {}
+
+    async def _pace(self, chat_id) -> None:
+        now = time.monotonic()
+        if len(self._next_slot) > 10000:
+            self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _send(self, chat_id, request: Callable[[], Awaitable], trace_id: str = None):
+        attempts = 0
+        flood_waits = 0
+        while True:
+            await self._pace(chat_id)
+            await self.bucket.acquire()
+            try:
+                async with self._semaphore:
+                    with metrics.timed('telegram_send', trace_id):
+                        return await request()
+            except RetryAfter as e:
+                metrics.RETRIES.inc(reason='flood_control')
+                flood_waits += 1
+                if flood_waits > self.max_retries:
+                    raise
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {delay}s")
+                self.bucket.pause(delay)
+            except (BadRequest, Forbidden):
+                raise
+            except NetworkError as e:
+                metrics.RETRIES.inc(reason='network')
+                attempts += 1
+                if attempts > self.max_retries:
+                    raise
+                delay = self._backoff(attempts)
+                logger.warning(f"Network error for chat {chat_id} ({str(e)}), retry {attempts} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def send_message(self, chat_id, text: str, trace_id: str = None):
+        return await self._send(chat_id, lambda: self.bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True
+        ), trace_id)
+
+    async def send_photo(self, chat_id, text: str, photo, trace_id: str = None):
+        return await self._send(chat_id, lambda: self.bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=text,
+            parse_mode=ParseMode.MARKDOWN
+        ), trace_id)
+
+    async def send_image(self, chat_id, text: str, image_url: str, trace_id: str = None) -> None:
+        file_id = await asyncio.to_thread(self.file_ids.get, image_url)
+        if file_id:
+            try:
+                await self.send_photo(chat_id, text, file_id, trace_id)
+                return
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logger.warning(f"Cached file_id rejected, uploading again: {str(e)}")
+                await asyncio.to_thread(self.file_ids.discard, image_url)
+
+        # Concurrent sends of the same image wait for the first upload and reuse its file_id
+        lock = self._upload_locks.setdefault(image_url, asyncio.Lock())
+        self._upload_users[image_url] = self._upload_users.get(image_url, 0) + 1
+        try:
+            async with lock:
+                file_id = self.file_ids.peek(image_url)
+                if file_id:
+                    await self.send_photo(chat_id, text, file_id, trace_id)
+                    return
+
+                with metrics.timed('image', trace_id):
+                    image_bytes = await asyncio.to_thread(self.get_image, image_url)
+                # Raw bytes rather than the stream, so retries upload the whole image again
+                sent = await self.send_photo(chat_id, text, image_bytes.getvalue(), trace_id)
+                if sent.photo:
+                    await asyncio.to_thread(self.file_ids.set, image_url, sent.photo[-1].file_id)
+        finally:
+            users = self._upload_users.pop(image_url) - 1
+            if users:
+                self._upload_users[image_url] = users
+            else:
+                self._upload_locks.pop(image_url, None)
+
+    async def deliver(self, message: dict) -> bool:
+        """
+        Delivers one rendered message, falling back to text if the image can't be sent.
+        Args:
+            message (dict): A message with 'user', 'text' and 'image' keys.
+        Returns:
+            bool: True if the message was delivered.
+        """
+        user_id = message['user']
+        trace_id = message.get('signature')
+        if message['image']:
+            try:
+                await self.send_image(user_id, message['text'], message['image'], trace_id)
+                metrics.DELIVERIES.inc(result='photo')
+                return True
+            except Exception as e:
+                logger.error(f"Error sending image to {user_id}, falling back to text: {str(e)}")
+                metrics.FALLBACKS.inc()
+
+        try:
+            await self.send_message(user_id, message['text'], trace_id)
+            metrics.DELIVERIES.inc(result='text')
+            return True
+        except Exception as e:
+            logger.error(f"Error sending message to {user_id}: {str(e)}")
+            metrics.DELIVERIES.inc(result='failed')
+            return False
+
+    async def deliver_many(self, messages: List[dict]) -> List[bool]:
+        return await asyncio.gather(*(self.deliver(message) for message in messages))
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Union
+
+from cachetools import TTLCache
+
+from source import metrics
+from source.render import TOKEN_PATTERN
+
+logger = logging.getLogger(__name__)
+
+
+class _Chat:
+    __slots__ = ('arrivals', 'pending', 'result')
+
+    def __init__(self):
+        self.arrivals = deque()
+        self.pending: Optional[List[dict]] = None
+        self.result: Optional[asyncio.Future] = None
+
+
+class DigestCoalescer:
+    """
+    Merges notification bursts for a chat into one digest message.
+    Chats that opted in get their first `threshold` notifications of a
+    `window` immediately; anything past that is held until the window ends
+    and sent as a single digest listing each transaction's type, source and
+    Solscan link. Chats that didn't opt in are delivered as before.
+    Args:
+        deliver (Callable[[dict], Awaitable[bool]]): Delivers one message, e.g. DeliveryEngine.deliver.
+        users: The pymongo users collection holding the per-user 'digest' flag.
+        window (float): Seconds a burst is collected for.
+        threshold (int): Notifications per window delivered one by one before coalescing starts.
+        default_enabled (bool): Whether users without a stored preference get digests.
+        max_lines (int): Transactions listed in one digest, the rest are counted.
+        preference_ttl (float): Seconds a user's preference is cached.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable[[dict], Awaitable[bool]],
+        users,
+        window: float = 10,
+        threshold: int = 3,
+        default_enabled: bool = False,
+        max_lines: int = 30,
+        preference_ttl: float = 60,
+    ):
+        self.deliver = deliver
+        self.users = users
+        self.window = window
+        self.threshold = threshold
+        self.default_enabled = default_enabled
+        self.max_lines = max_lines
+
+        self._preferences = TTLCache(maxsize=100000, ttl=preference_ttl)
+        self._chats: Dict[str, _Chat] = {}
+        self._flushes: Set[asyncio.Task] = set()
+
+    def _load_preferences(self, users: List[str]) -> Dict[str, bool]:
+        found = {
+            doc['_id']: bool(doc.get('digest', self.default_enabled))
+            for doc in self.users.find({'_id': {'$in': users}}, {'digest': 1})
+        }
+        return {user: found.get(user, self.default_enabled) for user in users}
+
+    async def enabled_users(self, users: Iterable[str]) -> Set[str]:
+        """Returns the users who get digests, reading unknown preferences from Mongo."""
+        users = set(users)
+        missing = [user for user in users if user not in self._preferences]
+        if missing:
+            try:
+                loaded = await asyncio.to_thread(self._load_preferences, missing)
+            except Exception as e:
+                logger.error(f"Error reading digest preferences: {str(e)}")
+                loaded = {user: self.default_enabled for user in missing}
+            self._preferences.update(loaded)
+        return {user for user in users if self._preferences.get(user, self.default_enabled)}
+
+    async def deliver_many(self, messages: List[dict]) -> List[Union[bool, asyncio.Future]]:
+        """
+        Delivers a batch without waiting for the messages held for a digest.
+        Returns:
+            List[Union[bool, asyncio.Future]]: Per message, whether it was delivered, or for
+                held messages a future of the digest's result, set when the window ends.
+        """
+        enabled = await self.enabled_users(message['user'] for message in messages)
+        held = [self._hold(message) if message['user'] in enabled else None for message in messages]
+        sent = iter(await asyncio.gather(*(
+            self.deliver(message) for message, future in zip(messages, held) if future is None
+        )))
+        return [future if future is not None else next(sent) for future in held]
+
+    def _hold(self, message: dict) -> Optional[asyncio.Future]:
+        """Adds a message to its chat's digest, or returns None when it should go out now."""
+        now = time.monotonic()
+        if len(self._chats) > 10000:
+            self._chats = {
+                user: chat for user, chat in self._chats.items()
+                if chat.pending is not None or (chat.arrivals and chat.arrivals[-1] > now - self.window)
+            }
+        chat = self._chats.setdefault(message['user'], _Chat())
+        while chat.arrivals and chat.arrivals[0] <= now - self.window:
+            chat.arrivals.popleft()
+        chat.arrivals.append(now)
+
+        if chat.pending is None and len(chat.arrivals) <= self.threshold:
+            return None
+
+        if chat.pending is None:
+            chat.pending = []
+            chat.result = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self._flush(message['user'], chat))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        chat.pending.append(message)
+        # Shielded, so a caller giving up on it can't cancel the digest for the others
+        return asyncio.shield(chat.result)
+
+    async def _flush(self, user: str, chat: _Chat) -> None:
+        await asyncio.sleep(self.window)
+        messages, result = chat.pending, chat.result
+        chat.pending, chat.result = None, None
+        try:
+            if len(messages) == 1:
+                ok = await self.deliver(messages[0])
+            else:
+                metrics.DIGESTS.inc()
+                metrics.COALESCED.inc(len(messages))
+                ok = await self.deliver(self.render(user, messages))
+        except Exception as e:
+            logger.error(f"Error sending digest to {user}: {str(e)}", exc_info=True)
+            ok = False
+        result.set_result(ok)
+
+    def render(self, user: str, messages: List[dict]) -> dict:
+        """
+        Builds the digest message for a burst.
+        Args:
+            user (str): The chat the digest goes to.
+            messages (List[dict]): The coalesced messages, oldest first.
+        Returns:
+            dict: A message with 'user', 'text', 'image' and 'signature' keys.
+        """
+        headings = [message.get('heading') or '*TRANSACTION*' for message in messages]
+        kinds = Counter(heading.split('*')[1] if heading.count('*') >= 2 else heading for heading in headings)
+        summary = ', '.join(f'{kind} x{count}' for kind, count in kinds.most_common())
+
+        lines = [f'*{len(messages)} transactions in the last {self.window:g}s*', summary, '']
+        for message, heading in list(zip(messages, headings))[:self.max_lines]:
+            signature = message.get('signature') or ''
+            # Activity summaries aren't transactions and have no explorer page
+            if TOKEN_PATTERN.fullmatch(signature):
+                lines.append(f"- {heading} | [Solscan](https://solscan.io/tx/{signature})")
+            else:
+                lines.append(f"- {heading}")
+        if len(messages) > self.max_lines:
+            lines.append(f'...and {len(messages) - self.max_lines} more')
+        return {'user': user, 'text': '\n'.join(lines), 'image': '', 'signature': None}
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Bounded in-memory queue drained by a pool of async workers.
+    The workers run on a dedicated event loop in a background thread, so the
+    (synchronous) Flask request thread only has to enqueue and return.
+    Args:
+        handler (Callable): Coroutine function called with every queued item.
+        workers (int): Number of concurrent worker tasks.
+        max_queue (int): Maximum number of items waiting in the queue.
+        enqueue_timeout (float): Seconds `submit` waits for a free slot before giving up.
+        on_start (Callable, optional): Coroutine run on the worker loop before the workers start.
+        on_stop (Callable, optional): Coroutine run on the worker loop after the workers stop.
+        threads (int, optional): Size of the loop's default executor, used by asyncio.to_thread.
+            Defaults to asyncio's min(32, cpus + 4).
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[None]],
+        workers: int,
+        max_queue: int,
+        enqueue_timeout: float,
+        on_start: Optional[Callable[[], Awaitable[None]]] = None,
+        on_stop: Optional[Callable[[], Awaitable[None]]] = None,
+        threads: Optional[int] = None,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.enqueue_timeout = enqueue_timeout
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.threads = threads
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._start_error: Optional[BaseException] = None
+
+    def start(self) -> None:
+        """
+        Starts the worker loop thread and blocks until the workers are running.
+        Raises:
+            Exception: Whatever `on_start` raised; the loop thread has exited.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='dispatcher', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            self._thread.join()
+            self._thread = None
+            self.loop = None
+            raise self._start_error
+
+    def _run(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        if self.threads:
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='dispatcher'))
+        self.loop.run_until_complete(self._main())
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    async def _main(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        try:
+            if self.on_start:
+                await self.on_start()
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        except Exception as e:
+            logger.error(f"Dispatcher failed to start: {str(e)}", exc_info=True)
+            self._start_error = e
+            return
+        finally:
+            # start() must never wait forever, whatever on_start did
+            self._ready.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.on_stop:
+            await self.on_stop()
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Dispatcher worker {number} failed: {str(e)}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, item: Any) -> bool:
+        """
+        Puts an item on the queue, waiting up to `enqueue_timeout` seconds for room.
+        Args:
+            item (Any): The item to hand over to the workers.
+        Returns:
+            bool: True if the item was queued, False if the queue stayed full.
+        """
+        if self.loop is None:
+            raise RuntimeError('Dispatcher is not started')
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self._queue.put(item), self.enqueue_timeout),
+            self.loop
+        )
+        try:
+            future.result()
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"Dispatcher queue full ({self.max_queue}), rejecting item")
+            return False
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stop(self, timeout: float = 30) -> None:
+        """Waits for the queue to drain (up to `timeout` seconds) and stops the workers."""
+        if self.loop is None or self._thread is None:
+            return
+
+        async def drain():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dispatcher stopped with {self._queue.qsize()} items left")
+            for task in self._tasks:
+                task.cancel()
+
+        asyncio.run_coroutine_threadsafe(drain(), self.loop).result()
+        self._thread.join(timeout)
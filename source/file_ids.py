@@ -0,0 +1,83 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from cachetools import TTLCache
+from pymongo.errors import PyMongoError
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    Bounded LRU/TTL cache of image URL -> Telegram file_id, persisted in Mongo.
+    Once a photo has been uploaded, every later send of the same image can
+    reference it by file_id instead of downloading and uploading it again.
+    Args:
+        collection: The pymongo collection used as the persistent store.
+        max_size (int): Maximum number of entries kept in memory.
+        ttl (float): Seconds an entry stays in memory. The Mongo TTL index is
+            created by source/schema.py from FILE_ID_CACHE_TTL.
+    """
+
+    def __init__(self, collection, max_size: int = 10000, ttl: float = 7 * 86400):
+        self.collection = collection
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def peek(self, key: str) -> Optional[str]:
+        """Returns the in-memory file_id for a key without touching Mongo."""
+        with self._lock:
+            return self._cache.get(key)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks a key up in memory, then in Mongo.
+        Args:
+            key (str): The image URL.
+        Returns:
+            Optional[str]: The Telegram file_id, or None if the image was never uploaded.
+        """
+        file_id = self.peek(key)
+        if file_id is not None:
+            metrics.CACHE.inc(cache='file_id', result='memory_hits')
+            return file_id
+
+        try:
+            doc = self.collection.find_one({'_id': key}, {'file_id': 1})
+        except PyMongoError as e:
+            logger.error(f"Error reading file_id: {str(e)}")
+            metrics.CACHE.inc(cache='file_id', result='errors')
+            return None
+        if doc is None:
+            metrics.CACHE.inc(cache='file_id', result='misses')
+            return None
+
+        with self._lock:
+            self._cache[key] = doc['file_id']
+        metrics.CACHE.inc(cache='file_id', result='store_hits')
+        return doc['file_id']
+
+    def set(self, key: str, file_id: str) -> None:
+        with self._lock:
+            self._cache[key] = file_id
+        try:
+            self.collection.update_one(
+                {'_id': key},
+                {'$set': {'file_id': file_id, 'created_at': datetime.utcnow()}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(f"Error saving file_id: {str(e)}")
+
+    def discard(self, key: str) -> None:
+        """Forgets a file_id Telegram no longer accepts."""
+        with self._lock:
+            self._cache.pop(key, None)
+        try:
+            self.collection.delete_one({'_id': key})
+        except PyMongoError as e:
+            logger.error(f"Error deleting file_id: {str(e)}")
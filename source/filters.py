@@ -0,0 +1,137 @@
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+LAMPORTS_PER_SOL = 1_000_000_000
+LIST_FIELDS = ('types', 'sources', 'muted')
+AMOUNT_FIELDS = ('min_sol', 'min_token')
+
+
+class TransactionFacts:
+    """
+    What notification filters look at in a transaction, extracted once per
+    transaction however many subscribers it has.
+    Args:
+        transaction (dict): One Helius enhanced transaction.
+        accounts (Iterable[str]): Accounts touched by the transaction.
+    """
+
+    __slots__ = ('type', 'source', 'accounts', 'sol', 'tokens')
+
+    def __init__(self, transaction: dict, accounts: Iterable[str]):
+        self.type = transaction.get('type') or ''
+        self.source = transaction.get('source') or ''
+        self.accounts = frozenset(accounts)
+        # Largest amount each account sent or received
+        self.sol: Dict[str, float] = {}
+        for transfer in transaction.get('nativeTransfers') or ():
+            amount = (transfer.get('amount') or 0) / LAMPORTS_PER_SOL
+            self._record(self.sol, transfer, amount)
+        self.tokens: Dict[str, float] = {}
+        for transfer in transaction.get('tokenTransfers') or ():
+            self._record(self.tokens, transfer, transfer.get('tokenAmount') or 0)
+
+    @staticmethod
+    def _record(amounts: Dict[str, float], transfer: dict, amount: float) -> None:
+        for side in ('fromUserAccount', 'toUserAccount'):
+            account = transfer.get(side)
+            if account and amount > amounts.get(account, 0):
+                amounts[account] = amount
+
+
+class NotificationFilter:
+    """
+    A subscription's notification filter, compiled from the 'filters' field
+    of its wallet document. Every condition that is set must hold: the
+    transaction type and source are in the allowed sets, no muted account
+    takes part, and the wallet moved at least `min_sol` SOL or `min_token`
+    tokens, whichever thresholds are set.
+    """
+
+    __slots__ = ('types', 'sources', 'muted', 'min_sol', 'min_token')
+
+    def __init__(self, types: Iterable[str] = (), sources: Iterable[str] = (), muted: Iterable[str] = (),
+                 min_sol: float = 0, min_token: float = 0):
+        self.types: FrozenSet[str] = frozenset(types)
+        self.sources: FrozenSet[str] = frozenset(sources)
+        self.muted: FrozenSet[str] = frozenset(muted)
+        self.min_sol = min_sol
+        self.min_token = min_token
+
+    @classmethod
+    def from_doc(cls, filters: Optional[dict]) -> Optional['NotificationFilter']:
+        """Compiles a stored filter, or returns None when it lets everything through."""
+        if not filters:
+            return None
+        compiled = cls(
+            types=filters.get('types') or (),
+            sources=filters.get('sources') or (),
+            muted=filters.get('muted') or (),
+            min_sol=filters.get('min_sol') or 0,
+            min_token=filters.get('min_token') or 0,
+        )
+        return compiled if compiled else None
+
+    def __bool__(self) -> bool:
+        return bool(self.types or self.sources or self.muted or self.min_sol or self.min_token)
+
+    def allows(self, facts: TransactionFacts, wallet: str) -> bool:
+        """
+        Args:
+            facts (TransactionFacts): The transaction.
+            wallet (str): The subscribed wallet the transaction touched.
+        Returns:
+            bool: True if the subscriber wants the notification.
+        """
+        if self.types and facts.type not in self.types:
+            return False
+        if self.sources and facts.source not in self.sources:
+            return False
+        if self.muted and not self.muted.isdisjoint(facts.accounts):
+            return False
+        if self.min_sol or self.min_token:
+            return bool(
+                (self.min_sol and facts.sol.get(wallet, 0) >= self.min_sol)
+                or (self.min_token and facts.tokens.get(wallet, 0) >= self.min_token)
+            )
+        return True
+
+
+def parse_filter(args: List[str]) -> Tuple[str, object]:
+    """
+    Parses the arguments of the bot's /filter command.
+    Args:
+        args (List[str]): e.g. ['types', 'swap', 'nft_sale'], ['min_sol', '0.5'] or ['types'] to clear.
+    Returns:
+        Tuple[str, object]: The filter field and its new value, empty to clear it.
+    Raises:
+        ValueError: Unknown field or invalid amount.
+    """
+    if not args:
+        raise ValueError('missing filter name')
+    field, values = args[0].lower(), args[1:]
+    if field in ('types', 'sources'):
+        return field, sorted({value.upper().strip(',') for value in values} - {''})
+    if field in AMOUNT_FIELDS:
+        if not values:
+            return field, 0
+        amount = float(values[0])
+        if amount < 0 or amount != amount or amount == float('inf'):
+            raise ValueError(f'invalid amount {values[0]}')
+        return field, amount
+    raise ValueError(f'unknown filter {field}')
+
+
+def describe(filters: Optional[dict]) -> List[str]:
+    """Lists a stored filter's conditions in plain words, empty if it lets everything through."""
+    filters = filters or {}
+    lines = []
+    if filters.get('types'):
+        lines.append(f"types: {', '.join(filters['types'])}")
+    if filters.get('sources'):
+        lines.append(f"sources: {', '.join(filters['sources'])}")
+    if filters.get('min_sol'):
+        lines.append(f"at least {filters['min_sol']:g} SOL")
+    if filters.get('min_token'):
+        lines.append(f"at least {filters['min_token']:g} tokens")
+    if filters.get('muted'):
+        lines.append(f"muted: {', '.join(filters['muted'])}")
+    return lines
@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+from typing import List
+
+from bson import json_util
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for the message history collection.
+    Documents are collected in memory and flushed with one unordered
+    insert_many once `batch_size` documents are waiting or `flush_interval`
+    seconds have passed. When Mongo is unreachable, or the buffer grows past
+    `max_buffer`, documents are spilled to a local JSON lines file which is
+    replayed after the next successful flush.
+    Args:
+        collection: The pymongo collection to write to.
+        batch_size (int): Number of buffered documents that triggers a flush.
+        flush_interval (float): Maximum seconds a document waits in the buffer.
+        max_buffer (int): Maximum number of documents kept in memory.
+        spill_path (str): Path of the local fallback file.
+    """
+
+    def __init__(self, collection, batch_size: int = 500, flush_interval: float = 2.0,
+                 max_buffer: int = 50000, spill_path: str = 'messages_spill.jsonl'):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+
+        self._buffer: List[dict] = []
+        self._condition = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def qsize(self) -> int:
+        return len(self._buffer)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, doc: dict) -> None:
+        """Queues a document without blocking on Mongo."""
+        overflow = None
+        with self._condition:
+            self._buffer.append(doc)
+            if len(self._buffer) >= self.max_buffer:
+                overflow, self._buffer = self._buffer, []
+            elif len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+        if overflow:
+            logger.warning(f"History buffer full, spilling {len(overflow)} documents to {self.spill_path}")
+            self._spill(overflow)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            with self._condition:
+                while len(self._buffer) < self.batch_size and not self._stop.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes out everything buffered so far, spilling to disk if Mongo is down."""
+        with self._condition:
+            docs, self._buffer = self._buffer, []
+        if not docs:
+            self._replay()
+            return
+
+        if self._insert(docs):
+            self._replay()
+        else:
+            self._spill(docs)
+
+    def _insert(self, docs: List[dict]) -> bool:
+        try:
+            with metrics.timed('mongo_insert'):
+                self.collection.insert_many(docs, ordered=False)
+            return True
+        except BulkWriteError as e:
+            # Replayed documents may already be stored, anything else is logged and dropped
+            errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != DUPLICATE_KEY]
+            if errors:
+                logger.error(f"History insert lost {len(errors)} documents: {errors[0].get('errmsg')}")
+            return True
+        except PyMongoError as e:
+            logger.error(f"History insert failed, spilling {len(docs)} documents: {str(e)}")
+            return False
+
+    def _spill(self, docs: List[dict]) -> None:
+        with self._spill_lock:
+            with open(self.spill_path, 'a') as f:
+                for doc in docs:
+                    f.write(json_util.dumps(doc) + '\n')
+
+    def _replay(self) -> None:
+        if not os.path.isfile(self.spill_path):
+            return
+        # Move the file aside so add() can keep spilling while we insert
+        replay_path = self.spill_path + '.replay'
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+        with open(replay_path) as f:
+            docs = [json_util.loads(line) for line in f if line.strip()]
+
+        for i in range(0, len(docs), self.batch_size):
+            if not self._insert(docs[i:i + self.batch_size]):
+                # Keep what is left for the next attempt
+                self._spill(docs[i:])
+                break
+        else:
+            logger.info(f"Replayed {len(docs)} spilled history documents")
+        os.remove(replay_path)
+
+    def stop(self) -> None:
+        """Stops the background thread and flushes what is left."""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
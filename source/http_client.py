@@ -0,0 +1,145 @@
+import asyncio
+import importlib.util
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import source.config as config
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Our POSTs are reads (token-metadata, RPC getAssetBatch), so they are as safe to retry as GETs
+RETRY_METHODS = frozenset(['GET', 'PUT', 'POST', 'DELETE'])
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def _timeout(timeout):
+    return timeout if timeout is not None else (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+
+
+def _observe(endpoint: str, started: float, status) -> None:
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status=str(status))
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the shared requests session, created on first use.
+    Connections are pooled and kept alive per host; connection errors and
+    retryable statuses are retried with backoff, honouring Retry-After.
+    Returns:
+        requests.Session: The session, safe to share between threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=config.HTTP_RETRIES,
+                backoff_factor=0.2,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=RETRY_METHODS,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=config.HTTP_POOL_HOSTS,
+                pool_maxsize=config.HTTP_POOL_SIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def request(method: str, url: str, endpoint: str, timeout=None, **kwargs) -> requests.Response:
+    """
+    Sends a request on the shared session and records its latency.
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL.
+        endpoint (str): Short name the latency is recorded under, e.g. 'helius.token_metadata'.
+        timeout: Seconds or a (connect, read) tuple, defaults to HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT.
+        **kwargs: Passed on to `requests.Session.request`.
+    Returns:
+        requests.Response: The response, whatever its status.
+    """
+    started = time.perf_counter()
+    try:
+        response = get_session().request(method, url, timeout=_timeout(timeout), **kwargs)
+    except requests.RequestException:
+        _observe(endpoint, started, 'error')
+        raise
+    _observe(endpoint, started, response.status_code)
+    return response
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the shared async client, created on first use, with HTTP/2 if
+    the h2 package is installed.
+    Returns:
+        httpx.AsyncClient: The client, bound to the running event loop.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        connect, read = _timeout(None)
+        _async_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec('h2') is not None,
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(
+                max_connections=config.HTTP_POOL_SIZE * config.HTTP_POOL_HOSTS,
+                max_keepalive_connections=config.HTTP_POOL_SIZE,
+            ),
+            # Retries failed connection attempts, statuses are retried below
+            transport=httpx.AsyncHTTPTransport(retries=config.HTTP_RETRIES),
+        )
+    return _async_client
+
+
+async def request_async(method: str, url: str, endpoint: str, timeout=None, **kwargs) -> httpx.Response:
+    """
+    Async version of `request` on the shared async client, with the same
+    retry policy for retryable statuses and transport errors.
+    """
+    if isinstance(timeout, tuple):
+        timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    elif timeout is None:
+        timeout = httpx.USE_CLIENT_DEFAULT
+
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            response = await get_async_client().request(method, url, timeout=timeout, **kwargs)
+        except httpx.TransportError:
+            _observe(endpoint, started, 'error')
+            if attempt >= config.HTTP_RETRIES:
+                raise
+        else:
+            _observe(endpoint, started, response.status_code)
+            if response.status_code not in RETRY_STATUSES or attempt >= config.HTTP_RETRIES:
+                return response
+
+        attempt += 1
+        await asyncio.sleep(random.uniform(0, 0.2 * 2 ** attempt))
+
+
+async def close_async_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
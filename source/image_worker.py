@@ -0,0 +1,100 @@
+import pickle
+import signal
+import socket
+import struct
+import sys
+from io import BytesIO
+from typing import Any, Tuple
+
+from PIL import Image
+
+# Started by ImageProcessor as `python -m source.image_worker <fd>`. It only
+# imports PIL, so a new worker is a fresh interpreter that inherits none of
+# the app's threads, sockets or Mongo clients.
+
+
+class PixelLimitError(Exception):
+    """The image has more pixels than allowed."""
+
+
+def send(sock: socket.socket, obj: Any) -> None:
+    """Sends one length-prefixed pickled frame."""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv(sock: socket.socket) -> Any:
+    """
+    Receives one frame sent with `send`.
+    Raises:
+        EOFError: The other end closed the socket.
+    """
+    size, = struct.unpack('!I', _read(sock, 4))
+    return pickle.loads(_read(sock, size))
+
+
+def _read(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1024 * 1024))
+        if not chunk:
+            raise EOFError("Socket closed")
+        data += chunk
+    return bytes(data)
+
+
+def prepare_image(data: bytes, max_size: Tuple[int, int], quality: int, max_pixels: int) -> bytes:
+    """
+    Decodes, downsizes and re-encodes an image as JPEG. Runs in a worker process.
+    Args:
+        data (bytes): The downloaded image.
+        max_size (Tuple[int, int]): Bounding box of the result.
+        quality (int): JPEG quality.
+        max_pixels (int): Images with more pixels are refused before decoding.
+    Returns:
+        bytes: The JPEG.
+    """
+    image = Image.open(BytesIO(data))
+    if image.width * image.height > max_pixels:
+        raise PixelLimitError(f"{image.width}x{image.height} image is over {max_pixels} pixels")
+
+    # JPEGs can be decoded straight at a 1/2, 1/4 or 1/8 scale close to the target size
+    if image.format == 'JPEG':
+        image.draft('RGB', max_size)
+    image = image.convert('RGB')
+
+    try:
+        resample = Image.Resampling.LANCZOS
+    except AttributeError:
+        resample = Image.ANTIALIAS
+
+    image.thumbnail(max_size, resample)
+    image_bytes = BytesIO()
+    image.save(image_bytes, 'JPEG', quality=quality)
+    return image_bytes.getvalue()
+
+
+def main() -> None:
+    # Ctrl-C reaches the whole process group, the parent closing the socket is what stops a worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    with sock:
+        while True:
+            try:
+                args = recv(sock)
+            except (EOFError, OSError):
+                return
+            try:
+                reply = ('ok', prepare_image(*args))
+            except PixelLimitError as e:
+                reply = ('pixels', str(e))
+            except Exception as e:
+                reply = ('decode', str(e))
+            try:
+                send(sock, reply)
+            except OSError:
+                return
+
+
+if __name__ == '__main__':
+    main()
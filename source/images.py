@@ -0,0 +1,204 @@
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+from typing import Optional, Tuple
+
+import source.config as config
+from source import http_client, image_worker, metrics
+
+logger = logging.getLogger(__name__)
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImageError(Exception):
+    """The image can't be sent as a photo: too big, too slow or undecodable."""
+
+
+class _Worker:
+    """A `source.image_worker` process and the socket it answers on."""
+
+    def __init__(self):
+        self.sock, child = socket.socketpair()
+        with child:
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', 'source.image_worker', str(child.fileno())],
+                pass_fds=(child.fileno(),),
+                cwd=_ROOT,
+            )
+
+    def call(self, args: tuple, timeout: float):
+        self.sock.settimeout(timeout)
+        image_worker.send(self.sock, args)
+        return image_worker.recv(self.sock)
+
+    def close(self) -> None:
+        # The worker exits once its socket is closed
+        self.sock.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    def kill(self) -> None:
+        self.sock.close()
+        self.process.kill()
+        self.process.wait()
+
+
+class ImageProcessor:
+    """
+    Downloads NFT images and prepares them for upload in worker processes.
+    Downloads stream with a byte cap and a deadline in the calling thread,
+    decoding and resizing run in `source.image_worker` processes so they
+    don't hold the GIL of the delivery path. Workers are started as fresh
+    interpreters rather than forked, so one that dies or hangs is replaced
+    safely while Mongo, dispatcher and resolver threads are running.
+    Anything too big or too slow raises ImageError and the message goes out
+    as text instead.
+    Args:
+        workers (int): Number of worker processes.
+        max_bytes (int): Largest download accepted.
+        max_pixels (int): Largest image accepted, in pixels.
+        download_timeout (float): Seconds allowed for the whole download.
+        process_timeout (float): Seconds allowed for decoding and resizing.
+        max_size (Tuple[int, int]): Bounding box of the prepared image.
+        quality (int): JPEG quality of the prepared image.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_pixels: int = 40_000_000,
+        download_timeout: float = 10,
+        process_timeout: float = 10,
+        max_size: Tuple[int, int] = (800, 800),
+        quality: int = 85,
+    ):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.download_timeout = download_timeout
+        self.process_timeout = process_timeout
+        self.max_size = max_size
+        self.quality = quality
+
+        # Idle workers, None stands for one that died and is started again on use
+        self._idle: "queue.Queue[Optional[_Worker]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = False
+
+    def start(self) -> None:
+        """
+        Starts the worker processes, so the first images don't wait for
+        Python and PIL to load.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for _ in range(self.workers):
+                self._idle.put(_Worker())
+
+    def download(self, url: str) -> bytes:
+        """
+        Streams an image, giving up past `max_bytes` or `download_timeout`.
+        Raises:
+            ImageError: The image is too big or too slow.
+            requests.RequestException: The download failed.
+        """
+        deadline = time.monotonic() + self.download_timeout
+        response = http_client.request('GET', url, 'image', stream=True, timeout=(config.HTTP_CONNECT_TIMEOUT, self.download_timeout))
+        with response:
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                metrics.IMAGES_SKIPPED.inc(reason='size')
+                raise ImageError(f"{url} is {length} bytes, over {self.max_bytes}")
+
+            data = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    metrics.IMAGES_SKIPPED.inc(reason='size')
+                    raise ImageError(f"{url} is over {self.max_bytes} bytes")
+                if time.monotonic() > deadline:
+                    metrics.IMAGES_SKIPPED.inc(reason='download_timeout')
+                    raise ImageError(f"{url} took over {self.download_timeout}s to download")
+        return bytes(data)
+
+    def _checkout(self) -> _Worker:
+        if self._stopped:
+            raise ImageError("Image workers are stopped")
+        self.start()
+        worker = self._idle.get()
+        if worker is None:
+            try:
+                worker = _Worker()
+            except Exception:
+                self._idle.put(None)
+                raise
+        return worker
+
+    def _checkin(self, worker: Optional[_Worker]) -> None:
+        with self._lock:
+            if not self._stopped:
+                self._idle.put(worker)
+                return
+        if worker is not None:
+            worker.close()
+
+    def get(self, url: str) -> BytesIO:
+        """
+        Downloads and prepares an image for upload.
+        Args:
+            url (str): The image URL.
+        Returns:
+            BytesIO: The JPEG, ready to send.
+        Raises:
+            ImageError: The image is too big, too slow or can't be decoded.
+        """
+        data = self.download(url)
+        worker = self._checkout()
+        try:
+            status, result = worker.call((data, self.max_size, self.quality, self.max_pixels), self.process_timeout)
+        except TimeoutError:
+            # The worker is replaced rather than left busy on an image nobody waits for
+            worker.kill()
+            self._checkin(None)
+            metrics.IMAGES_SKIPPED.inc(reason='process_timeout')
+            raise ImageError(f"{url} took over {self.process_timeout}s to process")
+        except (EOFError, OSError):
+            logger.error("Image worker died, starting a new one")
+            worker.kill()
+            self._checkin(None)
+            metrics.IMAGES_SKIPPED.inc(reason='worker_died')
+            raise ImageError(f"Image worker died processing {url}")
+        self._checkin(worker)
+
+        if status == 'ok':
+            return BytesIO(result)
+        metrics.IMAGES_SKIPPED.inc(reason=status)
+        if status == 'pixels':
+            raise ImageError(result)
+        raise ImageError(f"Can't decode {url}: {result}")
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stopped = True
+        # Waits for the idle workers to exit, busy ones are closed as they come back
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.close()
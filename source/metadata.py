@@ -0,0 +1,99 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from cachetools import TTLCache
+from pymongo.errors import PyMongoError
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """
+    Two-level cache of NFT image URLs keyed by mint or compressed asset ID.
+    An in-process LRU/TTL cache sits in front of a Mongo collection. Mint
+    metadata is effectively immutable, so resolved images are stored for good,
+    while "no image" answers are cached negatively for a shorter time.
+    Args:
+        collection: The pymongo collection used as the persistent store.
+        max_size (int): Maximum number of entries kept in memory (per kind).
+        ttl (float): Seconds a resolved image stays in memory.
+        negative_ttl (float): Seconds a "no image" answer is trusted, in memory and in Mongo.
+    """
+
+    def __init__(self, collection, max_size: int = 50000, ttl: float = 86400, negative_ttl: float = 3600):
+        self.collection = collection
+        self.negative_ttl = negative_ttl
+        self._positive = TTLCache(maxsize=max_size, ttl=ttl)
+        self._negative = TTLCache(maxsize=max_size, ttl=negative_ttl)
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'store_hits': 0, 'negative_hits': 0, 'misses': 0, 'errors': 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+        metrics.CACHE.inc(cache='metadata', result=name)
+
+    def record_error(self, count: int = 1) -> None:
+        """Counts failed fetches, which are not cached."""
+        with self._lock:
+            self._stats['errors'] += count
+        metrics.CACHE.inc(count, cache='metadata', result='errors')
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks a key up in memory, then in Mongo.
+        Args:
+            key (str): The cache key, e.g. 'mint:<address>' or 'asset:<id>'.
+        Returns:
+            Optional[str]: The image URL, '' if the asset is known to have no image, None on a miss.
+        """
+        with self._lock:
+            image = self._positive.get(key)
+            if image is None and key in self._negative:
+                image = ''
+        if image is not None:
+            self._count('memory_hits' if image else 'negative_hits')
+            return image
+
+        try:
+            doc = self.collection.find_one({'_id': key}, {'image': 1, 'expires_at': 1})
+        except PyMongoError as e:
+            logger.error(f"Error reading metadata cache: {str(e)}")
+            doc = None
+        # The TTL monitor only runs once a minute, so expired entries can still be returned
+        if doc is None or doc.get('expires_at', datetime.max) <= datetime.utcnow():
+            self._count('misses')
+            return None
+
+        self._remember(key, doc['image'])
+        self._count('store_hits' if doc['image'] else 'negative_hits')
+        return doc['image']
+
+    def _remember(self, key: str, image: str) -> None:
+        with self._lock:
+            if image:
+                self._positive[key] = image
+                self._negative.pop(key, None)
+            else:
+                self._negative[key] = True
+
+    def set(self, key: str, image: str) -> None:
+        self._remember(key, image)
+        now = datetime.utcnow()
+        if image:
+            update = {'$set': {'image': image, 'updated_at': now}, '$unset': {'expires_at': ''}}
+        else:
+            expires_at = now + timedelta(seconds=self.negative_ttl)
+            update = {'$set': {'image': '', 'updated_at': now, 'expires_at': expires_at}}
+        try:
+            self.collection.update_one({'_id': key}, update, upsert=True)
+        except PyMongoError as e:
+            logger.error(f"Error saving metadata cache: {str(e)}")
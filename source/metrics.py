@@ -0,0 +1,281 @@
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """A gauge read from a callback at scrape time, e.g. a queue depth, or set to a value."""
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def set(self, value: float, **labels) -> None:
+        """Sets a value for gauges too slow to read at scrape time."""
+        self.set_function(lambda: value, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            functions = dict(self._functions)
+        lines = []
+        for key, function in sorted(functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts, then sum and count
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(counts[-2])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {counts[-1]}')
+        return lines
+
+
+class TraceLog:
+    """
+    Stage timings of the most recent transactions, keyed by signature.
+    Traces are served to operators, so details must never identify users.
+    Args:
+        max_traces (int): Number of signatures kept.
+    """
+
+    def __init__(self, max_traces: int = 10000):
+        self.max_traces = max_traces
+        self._traces: "OrderedDict[str, List[dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, trace_id: str, stage: str, seconds: float, **details) -> None:
+        entry = {'stage': stage, 'seconds': round(seconds, 6), 'at': time.time(), **details}
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            if trace is None:
+                trace = self._traces[trace_id] = []
+                if len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            trace.append(entry)
+
+    def get(self, trace_id: str) -> Optional[List[dict]]:
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            return list(trace) if trace is not None else None
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: "OrderedDict[str, Metric]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+traces = TraceLog()
+
+STAGE_SECONDS = registry.histogram(
+    'soltrack_stage_seconds', 'Time spent in each webhook pipeline stage.', ['stage']
+)
+HTTP_SECONDS = registry.histogram(
+    'soltrack_http_request_seconds', 'Outbound HTTP request latency by endpoint.', ['endpoint']
+)
+HTTP_REQUESTS = registry.counter(
+    'soltrack_http_requests_total', 'Outbound HTTP requests by endpoint and status.', ['endpoint', 'status']
+)
+EVENTS = registry.counter('soltrack_events_total', 'Webhook transactions received.')
+WEBHOOKS = registry.counter('soltrack_webhooks_total', 'Webhook requests by response status.', ['status'])
+MESSAGES = registry.counter('soltrack_messages_total', 'Per-user messages rendered.')
+DELIVERIES = registry.counter('soltrack_deliveries_total', 'Telegram deliveries by result.', ['result'])
+FAILURES = registry.counter('soltrack_failures_total', 'Failures by pipeline stage.', ['stage'])
+FALLBACKS = registry.counter('soltrack_fallbacks_total', 'Image messages sent as text instead.')
+RETRIES = registry.counter('soltrack_telegram_retries_total', 'Telegram send retries by reason.', ['reason'])
+CACHE = registry.counter('soltrack_cache_total', 'Cache lookups by cache and result.', ['cache', 'result'])
+IMAGES_SKIPPED = registry.counter('soltrack_images_skipped_total', 'Images sent as text instead, by reason.', ['reason'])
+FILTERED = registry.counter('soltrack_filtered_total', 'Subscribers skipped by their notification filters.')
+ACTIVITY = registry.counter('soltrack_noisy_transactions_total', 'Transactions of noisy wallets by decision.', ['decision'])
+DUPLICATES = registry.counter('soltrack_duplicates_total', 'Redelivered (signature, user) pairs dropped.')
+OUTBOX = registry.counter('soltrack_outbox_total', 'Outbox messages by lease event.', ['event'])
+DIGESTS = registry.counter('soltrack_digests_total', 'Digest messages sent for notification bursts.')
+COALESCED = registry.counter('soltrack_coalesced_total', 'Notifications merged into digests.')
+BATCH_SIZE = registry.histogram(
+    'soltrack_resolver_batch_size', 'Keys per batched metadata lookup.', ['resolver'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+QUEUE_DEPTH = registry.gauge('soltrack_queue_depth', 'Items waiting in internal queues.', ['queue'])
+
+
+@contextmanager
+def timed(stage: str, trace_id: Optional[str] = None, **details):
+    """
+    Times a block into the stage histogram and, given a trace ID (the
+    transaction signature), into that transaction's trace.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        FAILURES.inc(stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if trace_id:
+            traces.record(trace_id, stage, seconds, **details)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, registry.render(), 'text/plain; version=0.0.4')
+        elif self.path.startswith('/traces/'):
+            signature = self.path[len('/traces/'):]
+            trace = traces.get(signature)
+            if trace is None:
+                self._reply(404, 'Not Found', 'text/plain')
+            else:
+                self._reply(200, json.dumps({'signature': signature, 'stages': trace}), 'application/json')
+        else:
+            self._reply(404, 'Not Found', 'text/plain')
+
+    def _reply(self, status: int, body: str, content_type: str) -> None:
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    """
+    Serves GET /metrics and GET /traces/<signature> in a background thread.
+    Meant for an internal interface, apart from the public webhook.
+    Args:
+        host (str): Interface to bind, e.g. '127.0.0.1'.
+        port (int): Port to bind, 0 disables the server.
+    Returns:
+        ThreadingHTTPServer: The running server, or None when disabled.
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
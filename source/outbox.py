@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from pymongo.errors import BulkWriteError
+
+from source import metrics
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class Outbox:
+    """
+    Durable queue of rendered deliveries in a Mongo collection.
+    Every message is stored as 'pending' under a (signature, user) key, so
+    re-enqueueing the same delivery is a no-op. Workers claim batches by
+    stamping them with a lease token and expiry in one update_many; a lease
+    that runs out, e.g. because its worker crashed, makes the messages
+    claimable again. Delivery is at least once: a worker that dies after
+    sending but before acknowledging causes a resend once the lease expires.
+    Args:
+        collection: The pymongo outbox collection.
+        lease_seconds (float): How long a claimed batch stays reserved for its worker.
+        max_attempts (int): Failed deliveries are given up on after this many claims.
+        retry_delay (float): Seconds a failed delivery waits before it can be claimed again.
+    """
+
+    def __init__(self, collection, lease_seconds: float = 300, max_attempts: int = 5, retry_delay: float = 60):
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    @staticmethod
+    def _claimable(now: datetime) -> dict:
+        return {'$or': [
+            {'status': 'pending', 'available_at': {'$lte': now}},
+            {'status': 'leased', 'lease_until': {'$lt': now}},
+        ]}
+
+    def enqueue(self, messages: List[dict]) -> int:
+        """
+        Stores rendered messages for delivery.
+        Args:
+            messages (List[dict]): Messages with 'user', 'text', 'image', 'signature' and optionally 'heading' keys.
+        Returns:
+            int: The number of new messages, already queued ones are skipped.
+        """
+        if not messages:
+            return 0
+        now = datetime.utcnow()
+        docs = [{
+            '_id': f"{message['signature']}:{message['user']}",
+            'user': message['user'],
+            'text': message['text'],
+            'image': message['image'],
+            'signature': message['signature'],
+            'heading': message.get('heading', ''),
+            'status': 'pending',
+            'attempts': 0,
+            'available_at': now,
+            'created_at': now,
+        } for message in messages]
+
+        try:
+            return len(self.collection.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != DUPLICATE_KEY for error in errors):
+                raise
+            return e.details.get('nInserted', 0)
+
+    def claim(self, owner: str, batch_size: int) -> Tuple[str, List[dict]]:
+        """
+        Atomically leases up to `batch_size` deliverable messages.
+        Candidates are read first, then leased with an update_many that
+        re-checks they are still claimable, so concurrent workers never
+        lease the same message.
+        Args:
+            owner (str): Identifies the worker in the lease, for debugging.
+            batch_size (int): Maximum number of messages to lease.
+        Returns:
+            Tuple[str, List[dict]]: The lease token and the leased messages.
+        """
+        now = datetime.utcnow()
+        candidates = [doc['_id'] for doc in self.collection.find(self._claimable(now), {'_id': 1}).limit(batch_size)]
+        if not candidates:
+            return '', []
+
+        token = uuid.uuid4().hex
+        self.collection.update_many(
+            {'_id': {'$in': candidates}, **self._claimable(now)},
+            {
+                '$set': {
+                    'status': 'leased',
+                    'lease_token': token,
+                    'lease_owner': owner,
+                    'lease_until': now + timedelta(seconds=self.lease_seconds),
+                },
+                '$inc': {'attempts': 1},
+            }
+        )
+        docs = list(self.collection.find({'lease_token': token}))
+        metrics.OUTBOX.inc(len(docs), event='claimed')
+        return token, docs
+
+    def ack(self, token: str, ids: List[str]) -> int:
+        """
+        Marks delivered messages as done, as long as the lease is still ours.
+        Returns:
+            int: The number of messages acknowledged.
+        """
+        if not ids:
+            return 0
+        result = self.collection.update_many(
+            {'_id': {'$in': ids}, 'lease_token': token},
+            {'$set': {'status': 'done', 'done_at': datetime.utcnow()}, '$unset': {'lease_token': ''}}
+        )
+        metrics.OUTBOX.inc(result.modified_count, event='acked')
+        return result.modified_count
+
+    def release(self, token: str, ids: List[str]) -> None:
+        """Returns failed deliveries to the queue after `retry_delay`, or gives up on them after `max_attempts`."""
+        if not ids:
+            return
+        now = datetime.utcnow()
+        leased = {'_id': {'$in': ids}, 'lease_token': token}
+        given_up = self.collection.update_many(
+            {**leased, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'status': 'failed', 'done_at': now}, '$unset': {'lease_token': ''}}
+        )
+        self.collection.update_many(
+            leased,
+            {
+                '$set': {'status': 'pending', 'available_at': now + timedelta(seconds=self.retry_delay)},
+                '$unset': {'lease_token': '', 'lease_until': ''},
+            }
+        )
+        metrics.OUTBOX.inc(given_up.modified_count, event='failed')
+        metrics.OUTBOX.inc(len(ids) - given_up.modified_count, event='released')
+
+    def pending_count(self) -> int:
+        return self.collection.count_documents({'status': 'pending'})
+
+
+class OutboxWorker:
+    """
+    Claims batches from the outbox and delivers them on the running event loop.
+    Several loops run side by side, so one slow batch (e.g. a chat held back
+    by per-chat pacing) doesn't stall the others. Any number of processes can
+    run workers on the same outbox. A delivery may answer with a future
+    instead of a result, e.g. for a message held for a digest; it is
+    acknowledged or released when the future resolves, while the loop goes
+    on claiming.
+    Args:
+        outbox (Outbox): The outbox to drain.
+        deliver (Callable[[List[dict]], Awaitable[List[bool]]]): Delivers a batch, e.g. DigestCoalescer.deliver_many.
+        owner (str): Worker name recorded in the leases.
+        batch_size (int): Messages claimed at a time per loop.
+        loops (int): Number of concurrent claim loops.
+        poll_interval (float): Seconds to wait for new messages when the outbox is empty.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        deliver: Callable[[List[dict]], Awaitable[List[bool]]],
+        owner: str,
+        batch_size: int = 50,
+        loops: int = 2,
+        poll_interval: float = 1.0,
+    ):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.owner = owner
+        self.batch_size = batch_size
+        self.loops = loops
+        self.poll_interval = poll_interval
+
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._tasks = []
+        self._settling: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """Starts the claim loops on the running event loop."""
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.loops)]
+
+    def wake(self) -> None:
+        """Skips the poll wait, e.g. right after this process enqueued messages."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self, number: int) -> None:
+        while not self._stopping:
+            try:
+                token, batch = await asyncio.to_thread(self.outbox.claim, self.owner, self.batch_size)
+            except Exception as e:
+                logger.error(f"Outbox claim failed: {str(e)}", exc_info=True)
+                batch = []
+
+            if not batch:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                continue
+
+            try:
+                results = await self.deliver(batch)
+            except Exception as e:
+                # Given back for a retry, so the loop keeps claiming
+                logger.error(f"Outbox worker {number} failed to deliver a batch: {str(e)}", exc_info=True)
+                results = [False] * len(batch)
+            deferred = [(doc, result) for doc, result in zip(batch, results) if isinstance(result, asyncio.Future)]
+            if deferred:
+                task = asyncio.create_task(self._settle(number, token, deferred))
+                self._settling.add(task)
+                task.add_done_callback(self._settling.discard)
+            await self._finish(number, token, [
+                (doc, result) for doc, result in zip(batch, results) if not isinstance(result, asyncio.Future)
+            ])
+
+    async def _settle(self, number: int, token: str, deferred: List[Tuple[dict, asyncio.Future]]) -> None:
+        results = await asyncio.gather(*(future for _, future in deferred), return_exceptions=True)
+        await self._finish(number, token, [(doc, result is True) for (doc, _), result in zip(deferred, results)])
+
+    async def _finish(self, number: int, token: str, results: List[Tuple[dict, bool]]) -> None:
+        delivered = [doc['_id'] for doc, ok in results if ok]
+        failed = [doc['_id'] for doc, ok in results if not ok]
+        try:
+            await asyncio.to_thread(self.outbox.ack, token, delivered)
+            await asyncio.to_thread(self.outbox.release, token, failed)
+        except Exception as e:
+            # The lease runs out and the batch is delivered again
+            logger.error(f"Outbox worker {number} couldn't acknowledge a batch: {str(e)}", exc_info=True)
+
+    async def stop(self) -> None:
+        """Lets the in-flight batches finish and acknowledge, then stops."""
+        self._stopping = True
+        self.wake()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(*self._settling, return_exceptions=True)
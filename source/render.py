@@ -0,0 +1,110 @@
+import re
+from typing import Dict, List
+
+ADDRESS_PATTERN = re.compile(r'[A-Za-z0-9]{32,44}')
+TOKEN_PATTERN = re.compile(r'([A-Za-z0-9]+)')
+
+
+def format_wallet_address(match_obj) -> str:
+    wallet_address = match_obj.group(0)
+    return wallet_address[:4] + "..." + wallet_address[-4:]
+
+
+def shorten(text: str) -> str:
+    return ADDRESS_PATTERN.sub(format_wallet_address, text)
+
+
+def your_wallet(wallet: str) -> str:
+    return f'*YOUR WALLET* ({wallet[:4]}...{wallet[-4:]})'
+
+
+class RenderedTransaction:
+    """
+    A transaction message rendered once, ready for cheap per-user output.
+    The text is split into alphanumeric runs and the separators between them.
+    Every run is shortened once up front; a user's message then only swaps the
+    runs holding one of their wallets for the *YOUR WALLET* form. Output is
+    identical to substituting the wallets into the whole text, then shortening
+    addresses and stripping '#' and '_', because wallets are alphanumeric and
+    can never reach across a separator.
+    Args:
+        transaction (dict): One Helius enhanced transaction.
+    """
+
+    def __init__(self, transaction: dict):
+        tx_type = transaction['type'].replace("_", " ")
+        tx = transaction['signature']
+        source = transaction['source']
+        description = transaction['description']
+
+        message = f'*{tx_type}*' + (f' on {source}' if source != "SYSTEM_PROGRAM" else '')
+        # Type and source alone, for digests
+        self.heading = message.replace("#", "").replace("_", " ")
+        if description:
+            message += f'\n\n{description}'
+        # Wallets are only highlighted in the description
+        self.personalized = bool(description)
+        self.text = message
+
+        # Odd indexes hold the alphanumeric runs, even ones the separators
+        self.parts = TOKEN_PATTERN.split(message)
+        self.rendered = [
+            shorten(part) if i % 2 else part.replace("#", "").replace("_", " ")
+            for i, part in enumerate(self.parts)
+        ]
+        self.runs: Dict[str, List[int]] = {}
+        for i in range(1, len(self.parts), 2):
+            self.runs.setdefault(self.parts[i], []).append(i)
+
+        links = f'\n[XRAY](https://xray.helius.xyz/tx/{tx}) | [Solscan](https://solscan.io/tx/{tx})'
+        self.links = links.replace("#", "").replace("_", " ")
+        self.generic = ''.join(self.rendered) + self.links
+
+    def for_user(self, wallets: List[str]) -> str:
+        """
+        Args:
+            wallets (List[str]): The user's wallets involved in the transaction.
+        Returns:
+            str: The message text for that user.
+        """
+        if not self.personalized:
+            return self.generic
+
+        touched: Dict[int, List[str]] = {}
+        for wallet in wallets:
+            if wallet not in self.text:
+                continue
+            if not TOKEN_PATTERN.fullmatch(wallet):
+                # Not a plain address, it could span separators
+                return self._render_slow(wallets)
+            exact = self.runs.get(wallet, ())
+            for i in exact:
+                touched.setdefault(i, []).append(wallet)
+            # Rare: the wallet sits inside a longer run
+            if self.text.count(wallet) > len(exact):
+                for i in range(1, len(self.parts), 2):
+                    if wallet in self.parts[i] and self.parts[i] != wallet:
+                        touched.setdefault(i, []).append(wallet)
+
+        if not touched:
+            return self.generic
+
+        rendered = list(self.rendered)
+        for i, run_wallets in touched.items():
+            run = self.parts[i]
+            if len(run_wallets) == 1 and run_wallets[0] == run:
+                rendered[i] = your_wallet(run)
+                continue
+            # Replace in the user's wallet order, exactly like a whole-text pass would
+            for wallet in wallets:
+                if wallet in run:
+                    run = run.replace(wallet, your_wallet(wallet))
+            rendered[i] = shorten(run)
+        return ''.join(rendered) + self.links
+
+    def _render_slow(self, wallets: List[str]) -> str:
+        message = self.text
+        for wallet in wallets:
+            if wallet in message:
+                message = message.replace(wallet, your_wallet(wallet))
+        return shorten(message).replace("#", "").replace("_", " ") + self.links
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from source import metrics
+from source.metadata import MetadataCache
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResolver:
+    """
+    Collects lookups from concurrent callers for `window` seconds and
+    resolves them with one batched call. Callers asking for a key that is
+    already queued or being fetched share its future.
+    Args:
+        fetch (Callable[[List[str]], Dict[str, str]]): Resolves a batch of keys, keys missing from the result
+            resolve to '' and keys mapped to an exception raise it.
+        name (str): Recorded in the batch size metric, e.g. 'token_metadata'.
+        window (float): Seconds to wait for more keys after the first one arrives.
+        max_batch (int): Keys per call; a full batch is sent without waiting.
+        workers (int): Batches fetched at the same time.
+    """
+
+    def __init__(self, fetch: Callable[[List[str]], Dict[str, str]], name: str,
+                 window: float = 0.005, max_batch: int = 100, workers: int = 4):
+        self.fetch = fetch
+        self.name = name
+        self.window = window
+        self.max_batch = max_batch
+
+        self._cond = threading.Condition()
+        self._queue: List[str] = []
+        self._futures: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'resolver-{name}')
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, key: str) -> Future:
+        """
+        Args:
+            key (str): The key to resolve, e.g. a mint address.
+        Returns:
+            Future: Resolves to the value, or raises what the batch call raised.
+        """
+        with self._cond:
+            future = self._futures.get(key)
+            if future is not None:
+                metrics.CACHE.inc(cache=self.name, result='coalesced')
+                return future
+            future = Future()
+            self._futures[key] = future
+            self._queue.append(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name=f'resolver-{self.name}', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _collect(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+            self._executor.submit(self._resolve, batch)
+
+    def _resolve(self, batch: List[str]) -> None:
+        metrics.BATCH_SIZE.observe(len(batch), resolver=self.name)
+        try:
+            results = self.fetch(batch)
+        except Exception as e:
+            logger.error(f"Batch {self.name} lookup of {len(batch)} keys failed: {str(e)}")
+            results, error = {}, e
+        else:
+            error = None
+
+        with self._cond:
+            futures = [(key, self._futures.pop(key)) for key in batch]
+        for key, future in futures:
+            if error is not None:
+                future.set_exception(error)
+            elif isinstance(results.get(key), Exception):
+                future.set_exception(results[key])
+            else:
+                future.set_result(results.get(key) or '')
+
+
+class MetadataResolver:
+    """
+    Resolves NFT images through the metadata cache, sending the misses of all
+    in-flight events to Helius in batches: one token-metadata call for mints
+    and one getAssetBatch call for compressed assets. Resolved images, and
+    the absence of one, are written to the cache; errors are not.
+    Args:
+        cache (MetadataCache): The image cache.
+        fetch_mints (Callable[[List[str]], Dict[str, str]]): Mint address -> image URL for a batch.
+        fetch_assets (Callable[[List[str]], Dict[str, str]]): Compressed asset ID -> image URL for a batch,
+            or -> the exception for assets whose lookup failed.
+        window (float): Seconds each batch waits for more keys.
+        mint_batch (int): Mints per token-metadata call.
+        asset_batch (int): Asset IDs per getAssetBatch call.
+    """
+
+    def __init__(self, cache: MetadataCache, fetch_mints, fetch_assets, window: float = 0.005,
+                 mint_batch: int = 100, asset_batch: int = 100):
+        self.cache = cache
+        self._resolvers = {
+            'mint': BatchResolver(self._cached(fetch_mints, 'mint'), 'token_metadata', window, mint_batch),
+            'asset': BatchResolver(self._cached(fetch_assets, 'asset'), 'asset_batch', window, asset_batch),
+        }
+
+    def _cached(self, fetch, kind: str) -> Callable[[List[str]], Dict[str, str]]:
+        def resolve(keys: List[str]) -> Dict[str, str]:
+            try:
+                images = fetch(keys)
+            except Exception:
+                self.cache.record_error(len(keys))
+                raise
+            failed = 0
+            for key in keys:
+                image = images.get(key)
+                if isinstance(image, Exception):
+                    failed += 1
+                    continue
+                self.cache.set(f'{kind}:{key}', image or '')
+            if failed:
+                self.cache.record_error(failed)
+            return images
+        return resolve
+
+    def resolve(self, key: str) -> Future:
+        """
+        Args:
+            key (str): A cache key, 'mint:<address>' or 'asset:<id>'.
+        Returns:
+            Future: Resolves to the image URL, or '' if there is none.
+        """
+        image = self.cache.get(key)
+        if image is not None:
+            future = Future()
+            future.set_result(image)
+            return future
+        kind, _, key = key.partition(':')
+        return self._resolvers[kind].submit(key)
@@ -0,0 +1,283 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+import source.config as config
+
+logger = logging.getLogger(__name__)
+
+INDEX_OPTIONS_CONFLICT = (85, 86)
+
+
+class SchemaError(Exception):
+    """A hot query would scan a whole collection, or a migration failed."""
+
+
+def _indexes() -> Dict[str, List[IndexModel]]:
+    # Default index names, so indexes created by earlier releases are recognised
+    return {
+        'wallets': [
+            # Subscribers of an address (webhook sync, bulk import)
+            IndexModel([('address', ASCENDING), ('status', ASCENDING)]),
+            # A user's wallets: count, list and duplicate check, covered by the index
+            IndexModel([('user_id', ASCENDING), ('status', ASCENDING), ('address', ASCENDING)]),
+            # One subscription per user and address, also serves deletes
+            IndexModel([('user_id', ASCENDING), ('address', ASCENDING)], unique=True),
+            # Subscriber index polling: changed wallets and the active count
+            IndexModel([('status', ASCENDING), ('updated_at', ASCENDING)]),
+        ],
+        'messages': [
+            IndexModel([('user', ASCENDING), ('datetime', DESCENDING)]),
+        ],
+        'file_ids': [
+            IndexModel('created_at', expireAfterSeconds=int(config.FILE_ID_CACHE_TTL)),
+        ],
+        'nft_metadata': [
+            # Only negative entries carry expires_at, positive ones never expire
+            IndexModel('expires_at', expireAfterSeconds=0),
+        ],
+        'outbox': [
+            # One index per branch of the claim query's $or
+            IndexModel([('status', ASCENDING), ('available_at', ASCENDING)]),
+            IndexModel([('status', ASCENDING), ('lease_until', ASCENDING)]),
+            IndexModel('lease_token', sparse=True),
+            # Delivered and failed messages are kept for a while, then dropped
+            IndexModel('done_at', expireAfterSeconds=int(config.OUTBOX_RETENTION)),
+        ],
+        'noisy_wallets': [
+            # Reports the bot hasn't sent to the wallet's users yet
+            IndexModel('notified', sparse=True),
+            IndexModel('last_seen', expireAfterSeconds=int(config.ACTIVITY_REPORT_TTL)),
+        ],
+        'delivered': [
+            IndexModel([('signature', ASCENDING), ('user', ASCENDING)], unique=True),
+            IndexModel('created_at', expireAfterSeconds=int(config.DEDUP_TTL)),
+        ],
+    }
+
+
+# Hot queries that must be answered from an index: (collection, name, filter, projection)
+HOT_QUERIES: List[Tuple[str, str, dict, Optional[dict]]] = [
+    ('wallets', 'wallet_count', {'user_id': '0', 'status': 'active'}, {'_id': 1}),
+    ('wallets', 'existing_wallet', {'user_id': '0', 'address': '', 'status': 'active'}, {'_id': 1}),
+    ('wallets', 'show_wallets', {'user_id': '0', 'status': 'active'}, {'address': 1}),
+    ('wallets', 'user_filters', {'user_id': '0', 'status': 'active', 'filters': {'$exists': True}}, {'filters': 1}),
+    ('wallets', 'delete_wallet', {'user_id': '0', 'address': ''}, None),
+    ('wallets', 'address_subscribers', {'address': {'$in': ['']}, 'status': 'active'}, {'address': 1}),
+    ('wallets', 'changed_wallets', {'status': 'active', 'updated_at': {'$gte': datetime.min}}, None),
+    ('messages', 'user_history', {'user': '0'}, None),
+    ('outbox', 'outbox_claim', {'$or': [
+        {'status': 'pending', 'available_at': {'$lte': datetime.min}},
+        {'status': 'leased', 'lease_until': {'$lt': datetime.min}},
+    ]}, {'_id': 1}),
+    ('outbox', 'outbox_lease', {'lease_token': ''}, None),
+    ('noisy_wallets', 'unnotified_noisy_wallets', {'notified': False}, None),
+]
+
+
+def _dedupe_wallets(db, names: Dict[str, str]) -> None:
+    """Removes duplicate (user_id, address) wallets so the unique index can be built."""
+    wallets = db[names['wallets']]
+    groups = wallets.aggregate([
+        # Active first, then oldest, so the kept document is the one users see
+        {'$sort': {'status': 1, '_id': 1}},
+        {'$group': {'_id': {'user_id': '$user_id', 'address': '$address'},
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    removed = 0
+    for group in groups:
+        removed += wallets.delete_many({'_id': {'$in': group['ids'][1:]}}).deleted_count
+    logger.info(f"Removed {removed} duplicate wallets")
+
+
+# (version, description, roles of the collections it changes, function(db, collection names)),
+# applied in order and never edited
+MIGRATIONS: List[Tuple[int, str, Tuple[str, ...], Callable]] = [
+    (1, 'remove duplicate (user_id, address) wallets', ('wallets',), _dedupe_wallets),
+]
+
+
+class SchemaManager:
+    """
+    Creates the indexes every process relies on, applies versioned data
+    migrations and checks with explain() that the hot queries use an index.
+    Safe to run from every process at startup: indexes are created
+    idempotently, and each migration is claimed in `schema_migrations`
+    before it runs, so it is applied once per set of collections it
+    changes. A process that finds a migration claimed by another waits up
+    to `migration_wait` for it, and a claim whose process died is taken
+    over once it is older than `migration_timeout`. While a migration is
+    still unapplied, the unique indexes of the collections it changes, which
+    may need its cleanup, are not built.
+    Args:
+        db: The pymongo database.
+        collections (Dict[str, str], optional): Collection names by role, e.g. {'wallets': 'wallets_test'}.
+        migration_timeout (float): Seconds after which a migration still marked as running is retried.
+        migration_wait (float): Seconds to wait for a migration another process is applying.
+    """
+
+    def __init__(self, db, collections: Dict[str, str] = None, migration_timeout: float = 3600,
+                 migration_wait: float = 60):
+        self.db = db
+        self.names = {role: role for role in _indexes()}
+        self.names.update(collections or {})
+        self.migrations = db.schema_migrations
+        self.migration_timeout = migration_timeout
+        self.migration_wait = migration_wait
+        # Roles whose migrations are still unapplied, so their unique indexes can't be built yet
+        self.unmigrated: Set[str] = set()
+
+    def ensure_indexes(self) -> None:
+        for role, models in _indexes().items():
+            collection = self.db[self.names[role]]
+            for model in models:
+                if model.document.get('unique') and role in self.unmigrated:
+                    logger.warning(f"Migrations pending, not building unique index {collection.name}.{model.document['name']}")
+                    continue
+                self._create_index(collection, model)
+
+    def _create_index(self, collection, model: IndexModel) -> None:
+        document = model.document
+        try:
+            collection.create_indexes([model])
+        except OperationFailure as e:
+            if e.code not in INDEX_OPTIONS_CONFLICT or 'expireAfterSeconds' not in document:
+                raise
+            # Only the TTL changed, which collMod updates in place
+            logger.info(f"Updating TTL of {collection.name}.{document['name']} to {document['expireAfterSeconds']}s")
+            self.db.command('collMod', collection.name, index={
+                'keyPattern': document['key'],
+                'expireAfterSeconds': document['expireAfterSeconds'],
+            })
+
+    def migrate(self) -> int:
+        """
+        Applies the migrations not recorded in `schema_migrations` yet.
+        Returns:
+            int: The number of migrations applied by this process.
+        """
+        applied = 0
+        for position, (version, description, roles, migration) in enumerate(MIGRATIONS):
+            collections = [self.names[role] for role in roles]
+            # The same migration runs once for each set of collections, e.g. wallets and wallets_test
+            key = f"{version}:{','.join(collections)}"
+            if not self._claim(key, version, description, collections):
+                finished = self._wait(key, version, description, collections)
+                if finished:
+                    continue
+                if finished is None:
+                    # Later migrations may depend on this one
+                    logger.warning(f"Migration {key} is still being applied by another process, skipping the rest")
+                    self.unmigrated = {role for _, _, roles, _ in MIGRATIONS[position:] for role in roles}
+                    break
+
+            logger.info(f"Applying migration {key}: {description}")
+            try:
+                migration(self.db, self.names)
+            except Exception as e:
+                self.migrations.delete_one({'_id': key})
+                raise SchemaError(f"Migration {key} ({description}) failed: {str(e)}") from e
+            self.migrations.update_one(
+                {'_id': key},
+                {'$set': {'state': 'done', 'applied_at': datetime.utcnow()}}
+            )
+            applied += 1
+        return applied
+
+    def _wait(self, key: str, version: int, description: str, collections: List[str]) -> Optional[bool]:
+        """
+        Waits for another process's run of a migration.
+        Returns:
+            Optional[bool]: True once it is done, False if its claim was given up or went stale
+                and is now ours, None if it is still running after `migration_wait` seconds.
+        """
+        deadline = time.monotonic() + self.migration_wait
+        while True:
+            state = self.migrations.find_one({'_id': key}, {'state': 1})
+            if state and state.get('state') == 'done':
+                return True
+            if self._claim(key, version, description, collections):
+                return False
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(1)
+
+    def _claim(self, key: str, version: int, description: str, collections: List[str]) -> bool:
+        """Claims a migration, or takes over one whose claim has gone stale. Returns True if it's ours to run."""
+        now = datetime.utcnow()
+        try:
+            self.migrations.insert_one({
+                '_id': key,
+                'version': version,
+                'collections': collections,
+                'description': description,
+                'state': 'running',
+                'started_at': now,
+            })
+            return True
+        except DuplicateKeyError:
+            pass
+
+        stale = self.migrations.find_one_and_update(
+            {'_id': key, 'state': 'running', 'started_at': {'$lt': now - timedelta(seconds=self.migration_timeout)}},
+            {'$set': {'started_at': now}}
+        )
+        if stale is not None:
+            logger.warning(f"Migration {key} was started at {stale['started_at']} and never finished, taking it over")
+        return stale is not None
+
+    def check_queries(self) -> List[str]:
+        """
+        Explains every hot query and lists those that would scan a whole collection.
+        Returns:
+            List[str]: The names of the queries without a usable index.
+        """
+        scans = []
+        for role, name, query, projection in HOT_QUERIES:
+            plan = self.db[self.names[role]].find(query, projection).limit(1).explain()
+            winning = plan.get('queryPlanner', {}).get('winningPlan', {})
+            if _has_stage(winning, 'COLLSCAN'):
+                scans.append(name)
+        return scans
+
+    def bootstrap(self, check: bool = True, strict: bool = False) -> None:
+        """
+        Migrates, builds the indexes and, if `check`, runs the query self-check.
+        Args:
+            check (bool): Explain the hot queries and log those scanning whole collections.
+            strict (bool): Refuse to start, rather than log, when the self-check finds a scan.
+        Raises:
+            SchemaError: A migration failed, or with `strict`, a hot query isn't using an index.
+        """
+        # Migrations first: the unique indexes need the data cleaned up
+        self.migrate()
+        self.ensure_indexes()
+        if not check:
+            return
+
+        try:
+            scans = self.check_queries()
+        except PyMongoError as e:
+            if strict:
+                raise
+            logger.warning(f"Query self-check failed: {str(e)}")
+            return
+        if scans and strict:
+            raise SchemaError(f"Hot queries scanning whole collections: {', '.join(scans)}")
+        if scans:
+            logger.warning(f"Hot queries scanning whole collections: {', '.join(scans)}")
+
+
+def _has_stage(plan, stage: str) -> bool:
+    if isinstance(plan, dict):
+        if plan.get('stage') == stage:
+            return True
+        return any(_has_stage(value, stage) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_stage(value, stage) for value in plan)
+    return False
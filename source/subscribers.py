@@ -0,0 +1,280 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from pymongo.errors import OperationFailure
+
+from source import metrics
+from source.filters import NotificationFilter, TransactionFacts
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriberIndex:
+    """
+    Resident address -> subscribers index over the wallets collection.
+    The index is loaded once at startup and kept current through a Mongo change
+    stream or, when change streams are unavailable (standalone servers don't
+    support them), by polling for wallets written since the last poll, with
+    a full reload only when the active count shows a removal or in the
+    periodic consistency check. Each subscription's notification
+    filter is compiled alongside it, so unwanted transactions are dropped
+    during the lookup, before any metadata, image or rendering work.
+    Args:
+        collection: The pymongo wallets collection.
+        poll_interval (float): Seconds between polls for changed wallets in polling mode.
+        check_interval (float): Seconds between full consistency checks.
+        change_streams (bool): Set to False to go straight to polling.
+    """
+
+    def __init__(self, collection, poll_interval: float = 10, check_interval: float = 600,
+                 change_streams: bool = True):
+        self.collection = collection
+        self.change_streams = change_streams
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+
+        self._lock = threading.RLock()
+        self._by_address: Dict[str, Set[str]] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        # Reference count per (user, address): duplicates must not vanish on a single delete
+        self._pairs: Dict[Tuple[str, str], int] = {}
+        # Active document id -> (user, address), delete events only carry the id
+        self._docs: Dict[object, Tuple[str, str]] = {}
+        # Only subscriptions with a filter are listed, so unfiltered lookups stay cheap
+        self._filters: Dict[Tuple[str, str], NotificationFilter] = {}
+        # Latest wallet updated_at applied, polling resumes from there
+        self._watermark = datetime.min
+
+        self._stop = threading.Event()
+        self._thread = None
+        self.mode = None
+
+    def start(self) -> None:
+        """Loads the index and starts following the collection in a background thread."""
+        self.load()
+        self._thread = threading.Thread(target=self._follow, name='subscriber-index', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _snapshot(self) -> Dict[object, Tuple[str, str, Optional[NotificationFilter]]]:
+        cursor = self.collection.find({"status": "active"}, {"user_id": 1, "address": 1, "filters": 1})
+        return {
+            doc['_id']: (doc['user_id'], doc['address'], NotificationFilter.from_doc(doc.get('filters')))
+            for doc in cursor
+        }
+
+    def load(self) -> int:
+        """
+        Replaces the index with a fresh snapshot of the active wallets.
+        Returns:
+            int: The number of active subscriptions loaded.
+        """
+        # Read before the snapshot, so wallets written meanwhile are polled again
+        latest = self.collection.find_one(
+            {"status": "active", "updated_at": {"$exists": True}}, {"updated_at": 1}, sort=[("updated_at", -1)]
+        )
+        snapshot = self._snapshot()
+        docs = {}
+        pairs = defaultdict(int)
+        by_address = defaultdict(set)
+        by_user = defaultdict(set)
+        filters = {}
+        for doc_id, (user, address, compiled) in snapshot.items():
+            docs[doc_id] = (user, address)
+            pairs[(user, address)] += 1
+            by_address[address].add(user)
+            by_user[user].add(address)
+            if compiled is not None:
+                filters[(user, address)] = compiled
+
+        with self._lock:
+            self._docs = docs
+            self._pairs = dict(pairs)
+            self._filters = filters
+            self._by_address = dict(by_address)
+            self._by_user = dict(by_user)
+            self._watermark = latest['updated_at'] if latest else datetime.min
+        return len(docs)
+
+    def refresh(self) -> int:
+        """
+        Applies the wallets added or changed since the last load or refresh,
+        and reloads everything when the active count shows a removal, which
+        leaves nothing to poll for.
+        Returns:
+            int: The number of changed subscriptions applied.
+        """
+        # Overlap the last interval: writes can commit slightly out of updated_at order
+        margin = timedelta(seconds=self.poll_interval)
+        since = self._watermark - margin if self._watermark > datetime.min + margin else datetime.min
+        changed = list(self.collection.find(
+            {"status": "active", "updated_at": {"$gte": since}},
+            {"user_id": 1, "address": 1, "filters": 1, "updated_at": 1}
+        ))
+        with self._lock:
+            for doc in changed:
+                self._remove(doc['_id'])
+                self._add(doc['_id'], doc['user_id'], doc['address'], NotificationFilter.from_doc(doc.get('filters')))
+                self._watermark = max(self._watermark, doc['updated_at'])
+            indexed = len(self._docs)
+
+        active = self.collection.count_documents({"status": "active"})
+        if active != indexed:
+            logger.info(f"Subscriber index holds {indexed} wallets, the collection {active}, reloading")
+            self.load()
+        return len(changed)
+
+    def _add(self, doc_id, user: str, address: str, compiled: Optional[NotificationFilter] = None) -> None:
+        self._docs[doc_id] = (user, address)
+        key = (user, address)
+        self._pairs[key] = self._pairs.get(key, 0) + 1
+        if compiled is not None:
+            self._filters[key] = compiled
+        else:
+            self._filters.pop(key, None)
+        self._by_address.setdefault(address, set()).add(user)
+        self._by_user.setdefault(user, set()).add(address)
+
+    def _remove(self, doc_id) -> None:
+        pair = self._docs.pop(doc_id, None)
+        if pair is None:
+            return
+        count = self._pairs.get(pair, 0) - 1
+        if count > 0:
+            self._pairs[pair] = count
+            return
+
+        self._pairs.pop(pair, None)
+        self._filters.pop(pair, None)
+        user, address = pair
+        users = self._by_address.get(address)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del self._by_address[address]
+        addresses = self._by_user.get(user)
+        if addresses is not None:
+            addresses.discard(address)
+            if not addresses:
+                del self._by_user[user]
+
+    def apply_change(self, change: dict) -> None:
+        """Applies one change stream event to the index."""
+        operation = change['operationType']
+        if operation in ('drop', 'rename', 'invalidate'):
+            self.load()
+            return
+
+        doc_id = change.get('documentKey', {}).get('_id')
+        with self._lock:
+            self._remove(doc_id)
+            doc = change.get('fullDocument')
+            if operation != 'delete' and doc and doc.get('status') == 'active':
+                self._add(doc_id, doc['user_id'], doc['address'], NotificationFilter.from_doc(doc.get('filters')))
+
+    def lookup(self, accounts: Iterable[str], transaction: dict = None) -> Dict[str, List[str]]:
+        """
+        Resolves the subscribers of a transaction.
+        Args:
+            accounts (Iterable[str]): Accounts touched by the transaction.
+            transaction (dict, optional): The transaction, to apply the subscribers' filters to.
+        Returns:
+            Dict[str, List[str]]: User ID -> that user's wallets among the accounts, for users
+                with at least one wallet whose filter lets the transaction through.
+        """
+        found = {}
+        with self._lock:
+            for address in accounts:
+                for user in self._by_address.get(address, ()):
+                    found.setdefault(user, []).append(address)
+            if transaction is None or not found or not self._filters:
+                return found
+
+            facts = None
+            for user, wallets in list(found.items()):
+                compiled = [self._filters.get((user, wallet)) for wallet in wallets]
+                if None in compiled:
+                    continue
+                if facts is None:
+                    facts = TransactionFacts(transaction, accounts)
+                if not any(f.allows(facts, wallet) for f, wallet in zip(compiled, wallets)):
+                    del found[user]
+                    metrics.FILTERED.inc()
+        return found
+
+    def tracked(self, accounts: Iterable[str]) -> Set[str]:
+        """Returns the accounts someone subscribes to, whatever their filters."""
+        with self._lock:
+            return {address for address in accounts if address in self._by_address}
+
+    def user_addresses(self, user_id: str) -> Set[str]:
+        with self._lock:
+            return set(self._by_user.get(user_id, ()))
+
+    def check_consistency(self, repair: bool = True) -> Tuple[int, int]:
+        """
+        Compares the index against the database.
+        Args:
+            repair (bool): Reload the index when it has drifted.
+        Returns:
+            Tuple[int, int]: Subscriptions missing from the index, and stale ones still in it.
+        """
+        expected = {(user, address) for user, address, _ in self._snapshot().values()}
+        with self._lock:
+            actual = set(self._pairs)
+        missing = len(expected - actual)
+        stale = len(actual - expected)
+
+        if missing or stale:
+            logger.warning(f"Subscriber index drifted: {missing} missing, {stale} stale")
+            if repair:
+                self.load()
+        return missing, stale
+
+    def _follow(self) -> None:
+        if not self.change_streams:
+            self._poll()
+            return
+        while not self._stop.is_set():
+            try:
+                self._watch()
+            except (OperationFailure, NotImplementedError) as e:
+                logger.info(f"Change streams unavailable ({str(e)}), polling every {self.poll_interval}s")
+                self._poll()
+            except Exception as e:
+                # Never let the thread die, the index would silently go stale
+                logger.error(f"Subscriber index watch failed: {str(e)}", exc_info=True)
+                self._stop.wait(self.poll_interval)
+
+    def _watch(self) -> None:
+        with self.collection.watch(full_document='updateLookup', max_await_time_ms=1000) as stream:
+            self.mode = 'watch'
+            # Changes made while loading are replayed from the stream, which is idempotent
+            self.load()
+            next_check = time.monotonic() + self.check_interval
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.apply_change(change)
+                elif time.monotonic() >= next_check:
+                    self.check_consistency()
+                    next_check = time.monotonic() + self.check_interval
+
+    def _poll(self) -> None:
+        self.mode = 'poll'
+        next_check = time.monotonic() + self.check_interval
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if time.monotonic() >= next_check:
+                    self.check_consistency()
+                    next_check = time.monotonic() + self.check_interval
+                else:
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Subscriber index poll failed: {str(e)}", exc_info=True)
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from source.bot_tools import HELIUS_WEBHOOK_URL, get_webhook_async, list_webhooks_async, put_webhook_async, webhook_for_address
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookSync:
+    """
+    Keeps the Helius webhook address lists in line with the wallets collection.
+    The desired address set is derived from the active wallets and is the
+    source of truth. Addresses are sharded across a pool of webhooks by
+    rendezvous hashing. Changed addresses are collected over a short window and
+    only the shards they belong to are pushed, with one PUT per shard per
+    window; a periodic reconcile compares every webhook with the collection to
+    catch drift and to rebalance after the pool changes. Every pool webhook is
+    recorded in `managed`; with `retire` set, recorded webhooks that were
+    dropped from the pool are emptied so they stop sending duplicate events.
+    Retiring is opt-in since a typo or a partial pool in the config would
+    otherwise wipe live shards, and webhooks this service never managed are
+    left alone either way.
+    Args:
+        collection: The pymongo wallets collection.
+        webhook_ids (List[str]): The pool of Helius webhook IDs to manage.
+        managed: The pymongo collection recording the webhooks ever managed.
+        retire (bool): Empty managed webhooks that are no longer in the pool.
+        window (float): Seconds to coalesce changes before pushing.
+        reconcile_interval (float): Seconds between drift checks against Helius.
+        max_addresses (int): Address cap of a single webhook, exceeding it is logged.
+    """
+
+    def __init__(self, collection, webhook_ids: List[str], managed=None, retire: bool = False,
+                 window: float = 2.0, reconcile_interval: float = 600, max_addresses: int = 100000):
+        if not webhook_ids:
+            raise ValueError('At least one webhook ID is required')
+        self.collection = collection
+        self.webhook_ids = list(webhook_ids)
+        self.managed = managed
+        self.retire = retire
+        self.window = window
+        self.reconcile_interval = reconcile_interval
+        self.max_addresses = max_addresses
+
+        self._desired: Dict[str, Set[str]] = {i: set() for i in self.webhook_ids}
+        self._pending: Set[str] = set()
+        self._dirty: Set[str] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Loads the desired address sets and starts the sync loop on the running event loop."""
+        self._wake = asyncio.Event()
+        try:
+            await self.reconcile()
+        except Exception as e:
+            logger.error(f"Initial webhook reconcile failed: {str(e)}", exc_info=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._pending or self._dirty:
+            await self.flush()
+
+    def notify(self, address: str) -> None:
+        """Marks an address whose subscriptions changed; it is re-read from Mongo on the next flush."""
+        self._pending.add(address)
+        if self._wake is not None:
+            self._wake.set()
+
+    def shard(self, address: str) -> str:
+        return webhook_for_address(address, self.webhook_ids)
+
+    def _active_addresses(self, addresses=None) -> Set[str]:
+        query = {"status": "active"}
+        if addresses is not None:
+            query["address"] = {"$in": list(addresses)}
+        return set(self.collection.distinct("address", query))
+
+    async def flush(self) -> bool:
+        """
+        Applies the pending changes and pushes the shards that changed.
+        Flushes are serialized, so an older snapshot of a shard can never
+        overwrite a newer one.
+        Returns:
+            bool: False if Helius rejected an update (it will be retried).
+        """
+        async with self._lock():
+            return await self._flush()
+
+    def _lock(self) -> asyncio.Lock:
+        # Created on first use so it belongs to the loop the sync runs on
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def _flush(self) -> bool:
+        pending, self._pending = self._pending, set()
+        if pending:
+            try:
+                active = await asyncio.to_thread(self._active_addresses, pending)
+            except Exception:
+                self._pending |= pending
+                raise
+            for address in pending:
+                webhook_id = self.shard(address)
+                addresses = self._desired[webhook_id]
+                if address in active and address not in addresses:
+                    addresses.add(address)
+                    self._dirty.add(webhook_id)
+                elif address not in active and address in addresses:
+                    addresses.discard(address)
+                    self._dirty.add(webhook_id)
+
+        success = True
+        for webhook_id in list(self._dirty):
+            addresses = self._desired[webhook_id]
+            if len(addresses) > self.max_addresses:
+                logger.error(f"Webhook {webhook_id} holds {len(addresses)} addresses, over the {self.max_addresses} cap")
+            if await put_webhook_async(webhook_id, sorted(addresses)):
+                self._dirty.discard(webhook_id)
+            else:
+                success = False
+        return success
+
+    async def reconcile(self) -> None:
+        """Reloads the desired sets from Mongo and pushes every shard that has drifted."""
+        if self.managed is not None:
+            await asyncio.to_thread(self._record_managed)
+        async with self._lock():
+            active = await asyncio.to_thread(self._active_addresses)
+            desired = {i: set() for i in self.webhook_ids}
+            for address in active:
+                desired[self.shard(address)].add(address)
+            self._desired = desired
+
+            for webhook_id in self.webhook_ids:
+                success, _, remote = await get_webhook_async(webhook_id)
+                if not success:
+                    continue
+                remote = set(remote)
+                if remote != desired[webhook_id]:
+                    logger.warning(
+                        f"Webhook {webhook_id} drift: {len(desired[webhook_id] - remote)} missing, "
+                        f"{len(remote - desired[webhook_id])} extra"
+                    )
+                    self._dirty.add(webhook_id)
+            if self._dirty:
+                await self._flush()
+        await self.retire_removed()
+
+    def _record_managed(self) -> None:
+        now = datetime.utcnow()
+        for webhook_id in self.webhook_ids:
+            self.managed.update_one(
+                {"_id": webhook_id},
+                {"$set": {"url": HELIUS_WEBHOOK_URL, "last_managed": now}},
+                upsert=True,
+            )
+
+    def _managed_ids(self) -> Set[str]:
+        return {doc["_id"] for doc in self.managed.find({"url": HELIUS_WEBHOOK_URL}, {"_id": 1})}
+
+    async def retire_removed(self) -> None:
+        """
+        Empties the webhooks this service managed before that deliver to our URL
+        but are no longer in the pool. Without `retire` they are only logged.
+        """
+        if self.managed is None:
+            return
+        success, webhooks = await list_webhooks_async()
+        if not success:
+            return
+        managed = await asyncio.to_thread(self._managed_ids)
+        for webhook in webhooks:
+            webhook_id = webhook.get('webhookID')
+            if webhook_id in self.webhook_ids or webhook_id not in managed or webhook.get('webhookURL') != HELIUS_WEBHOOK_URL:
+                continue
+            addresses = webhook.get('accountAddresses') or []
+            if not addresses:
+                continue
+            if not self.retire:
+                logger.warning(
+                    f"Webhook {webhook_id} is no longer configured but tracks {len(addresses)} addresses and may send "
+                    f"duplicate events, set HELIUS_RETIRE_REMOVED_WEBHOOKS=1 to empty it"
+                )
+                continue
+            logger.warning(f"Webhook {webhook_id} is no longer configured but tracks {len(addresses)} addresses, emptying it")
+            if not await put_webhook_async(webhook_id, []):
+                logger.error(f"Couldn't empty removed webhook {webhook_id}, it keeps sending duplicate events")
+
+    async def _run(self) -> None:
+        next_reconcile = time.monotonic() + self.reconcile_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0, next_reconcile - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                if self._wake.is_set():
+                    # Let more changes arrive before pushing
+                    await asyncio.sleep(self.window)
+                    self._wake.clear()
+                    if not await self.flush():
+                        await asyncio.sleep(self.window)
+                        self._wake.set()
+                if time.monotonic() >= next_reconcile:
+                    await self.reconcile()
+                    next_reconcile = time.monotonic() + self.reconcile_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Webhook sync failed: {str(e)}", exc_info=True)
+                await asyncio.sleep(self.window)
+                if self._pending or self._dirty:
+                    self._wake.set()
@@ -0,0 +1,120 @@
+import warnings
+from cryptography.utils import CryptographyDeprecationWarning
+warnings.filterwarnings("ignore", category=CryptographyDeprecationWarning)
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from pymongo import MongoClient
+from telegram.ext import Application
+
+import source.config as config
+from source import metrics
+from source.delivery import DeliveryEngine
+from source.digest import DigestCoalescer
+from source.file_ids import FileIdCache
+from source.images import ImageProcessor
+from source.outbox import Outbox, OutboxWorker
+from source.schema import SchemaManager
+
+# Standalone delivery worker: drains the outbox that app.py fills. Run as many
+# as needed, on any machine; DELIVERY_RATE applies per process, so split
+# Telegram's global limit between them.
+
+# Set up logging
+logging.basicConfig(
+    filename=os.path.join(config.LOG_DIR, 'worker.log'),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Image workers are started up front so the first images don't wait for them to load
+images = ImageProcessor(
+    workers=config.IMAGE_WORKERS,
+    max_bytes=config.IMAGE_MAX_BYTES,
+    max_pixels=config.IMAGE_MAX_PIXELS,
+    download_timeout=config.IMAGE_DOWNLOAD_TIMEOUT,
+    process_timeout=config.IMAGE_PROCESS_TIMEOUT,
+)
+images.start()
+
+# Database setup
+client = MongoClient(config.MONGODB_URI)
+db = client.sol_wallets
+SchemaManager(
+    db,
+    {'wallets': config.WALLETS_COLLECTION},
+    migration_timeout=config.SCHEMA_MIGRATION_TIMEOUT,
+    migration_wait=config.SCHEMA_MIGRATION_WAIT,
+).bootstrap(check=config.SCHEMA_CHECK, strict=config.SCHEMA_CHECK_STRICT)
+
+file_ids = FileIdCache(db.file_ids, max_size=config.FILE_ID_CACHE_SIZE, ttl=config.FILE_ID_CACHE_TTL)
+outbox = Outbox(
+    db.outbox,
+    lease_seconds=config.OUTBOX_LEASE_SECONDS,
+    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+    retry_delay=config.OUTBOX_RETRY_DELAY,
+)
+
+application = (
+    Application.builder()
+    .token(config.BOT_TOKEN)
+    .base_url(config.TELEGRAM_API_URL)
+    .connection_pool_size(config.DELIVERY_CONCURRENCY)
+    .build()
+)
+
+
+async def main() -> None:
+    await application.bot.initialize()
+    delivery = DeliveryEngine(
+        application.bot,
+        file_ids,
+        images.get,
+        rate=config.DELIVERY_RATE,
+        chat_interval=config.DELIVERY_CHAT_INTERVAL,
+        concurrency=config.DELIVERY_CONCURRENCY,
+        max_retries=config.DELIVERY_MAX_RETRIES,
+    )
+    digests = DigestCoalescer(
+        delivery.deliver,
+        db.users,
+        window=config.DIGEST_WINDOW,
+        threshold=config.DIGEST_THRESHOLD,
+        default_enabled=config.DIGEST_DEFAULT,
+        max_lines=config.DIGEST_MAX_LINES,
+        preference_ttl=config.DIGEST_PREFERENCE_TTL,
+    )
+    worker = OutboxWorker(
+        outbox,
+        digests.deliver_many,
+        owner=f'{socket.gethostname()}:{os.getpid()}',
+        batch_size=config.OUTBOX_BATCH_SIZE,
+        loops=config.OUTBOX_LOOPS,
+        poll_interval=config.OUTBOX_POLL_INTERVAL,
+    )
+    worker.start()
+    # Send, image and delivery metrics of this process, on the internal bind like app.py's
+    metrics.serve(config.METRICS_HOST, config.WORKER_METRICS_PORT)
+    logger.info('Outbox worker started')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info('Stopping outbox worker')
+    await worker.stop()
+    await application.bot.shutdown()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    finally:
+        images.stop()